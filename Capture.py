@@ -0,0 +1,128 @@
+import gzip
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+
+# Binary capture of received frames, see Gateway.record and Gateway.replay
+#
+# file:   magic, then records until the end of the file
+# record: int64 time.monotonic_ns(), uint16 number of pulses, uint16 pulses
+# little endian. A capture is only appended to, a capture that is appended to
+# later continues with the timestamps of the new process. Captures with a .gz
+# name are gzip compressed, others can be memory mapped for reading.
+# A background thread flushes a capture every flush_interval seconds when
+# frames were written, so a capture that is still being written, or of a
+# process that crashed, can be read up to about flush_interval ago, also when
+# no frames came in since.
+magic = b'RFLCAP1\n'
+record_header = struct.Struct('<qH')
+# pulses are stored as uint16, longer pulses are clipped
+max_pulse = 0xFFFF
+
+
+def is_compressed(filename):
+    return filename.endswith('.gz')
+
+
+# appends frames to a capture
+class Writer:
+    def __init__(self, filename, compress=None, flush_interval: float = 1.0):
+        self.filename = filename
+        if compress is None:
+            compress = is_compressed(filename)
+        empty = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        self.file = gzip.open(filename, 'ab') if compress else open(filename, 'ab')
+        if empty:
+            self.file.write(magic)
+        self.count = 0
+        self.flush_interval = flush_interval
+        self.unflushed = False
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.__run, name='Capture', daemon=True)
+        self.thread.start()
+
+    def write(self, pulses, timestamp=None):
+        if pulses.typecode != 'H':
+            pulses = array('H', (min(p, max_pulse) for p in pulses))
+        elif sys.byteorder != 'little':
+            pulses = array('H', pulses)
+        if sys.byteorder != 'little':
+            pulses.byteswap()
+        n = min(len(pulses), max_pulse)
+        header = record_header.pack(time.monotonic_ns() if timestamp is None else timestamp, n)
+        with self.lock:
+            self.file.write(header)
+            self.file.write(memoryview(pulses)[:n])
+            self.count += 1
+            self.unflushed = True
+
+    # a gzip capture is flushed to a byte boundary of the deflate stream, so
+    # everything written so far can be decompressed, see read_compressed
+    def flush(self):
+        with self.lock:
+            if self.unflushed and not self.file.closed:
+                self.file.flush()
+                self.unflushed = False
+
+    def __run(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            self.file.close()
+
+
+# yields the (timestamp, pulses) records of a capture, pulses is an array('H')
+# an incomplete last record, of a capture that was still being written, is skipped
+def read(filename):
+    with open(filename, 'rb') as f:
+        if is_compressed(filename):
+            yield from records(read_compressed(f))
+        elif os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                yield from records(m)
+
+
+# the decompressed content of a gzip file of one or more members, a truncated
+# last member (a capture that is still being written) is read as far as it goes
+def read_compressed(f, chunk_size=1 << 16):
+    data = bytearray()
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        while chunk:
+            data += decompressor.decompress(chunk)
+            if not decompressor.eof:
+                break
+            # the next member, if any
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    return data
+
+
+def records(buffer):
+    if buffer[:len(magic)] != magic:
+        raise Exception('not a capture file')
+    offset = len(magic)
+    end = len(buffer)
+    while offset + record_header.size <= end:
+        timestamp, n = record_header.unpack_from(buffer, offset)
+        offset += record_header.size
+        if offset + 2 * n > end:
+            break
+        pulses = array('H')
+        pulses.frombytes(buffer[offset:offset + 2 * n])
+        if sys.byteorder != 'little':
+            pulses.byteswap()
+        offset += 2 * n
+        yield timestamp, pulses
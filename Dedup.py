@@ -0,0 +1,32 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Drops repeated transmissions of the same decoded frame.
+# A key is a duplicate when it was last seen less than window seconds ago, so
+# the frames of a held button are one event however long it is held.
+# At most capacity keys are remembered, the oldest are forgotten first.
+class Deduplicator:
+    def __init__(self, window: float = 0.5, capacity: int = 1024):
+        self.window = window
+        self.capacity = capacity
+        self.seen = OrderedDict()  # key -> time last seen, oldest first
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def is_duplicate(self, key, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            last = self.seen.get(key)
+            self.seen[key] = now
+            self.seen.move_to_end(key)
+            if last is not None and now - last < self.window:
+                self.dropped += 1
+                return True
+            # forget the keys that expired or do not fit
+            expired = now - self.window
+            while self.seen and (len(self.seen) > self.capacity or next(iter(self.seen.values())) <= expired):
+                self.seen.popitem(last=False)
+            return False
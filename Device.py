@@ -1,10 +1,50 @@
-import logging
+import contextlib
+import threading
+from EventBus import Event
+from Fingerprint import SignalIndex
+from History import InstanceState, EventHistory, epoch_seconds, to_datetime
+from Dedup import Deduplicator
+
+
+# cheap per-frame features a device type can accept, used by the gateway
+# to pre-select the parsers that are worth trying for a received frame.
+# header is a sequence of (min, max) pulse widths for the leading pulses.
+class FrameSignature:
+    def __init__(self, min_pulses=0, max_pulses=None, min_length=0, max_length=None, header=()):
+        self.min_pulses = min_pulses
+        self.max_pulses = max_pulses
+        self.min_length = min_length
+        self.max_length = max_length
+        self.header = tuple(header)
+
+    def matches(self, pulses, length):
+        if len(pulses) < self.min_pulses:
+            return False
+        if self.max_pulses is not None and len(pulses) > self.max_pulses:
+            return False
+        if length < self.min_length:
+            return False
+        if self.max_length is not None and length > self.max_length:
+            return False
+        for pulse, (low, high) in zip(pulses, self.header):
+            if not low <= pulse <= high:
+                return False
+        return True
 
 
 # base class for all device instances
 class DeviceInstance:
-    def __init__(self, id: str):
+    # number of recent events kept per instance
+    history_size = 64
+    # name of the transceiver that sends the commands of this instance, None for any
+    transmitter = None
+
+    def __init__(self, id: str, key=None):
         self.id = id
+        # native id used to index the instance, e.g. an integer address
+        self.key = id if key is None else key
+        self.state = InstanceState()
+        self.history = None  # allocated with the first event
 
     def parse(self, timestamp, pulses):
         return False
@@ -12,29 +52,125 @@ class DeviceInstance:
     def get_id(self):
         return self.id
 
+    # records a decoded event, timestamp is the time.monotonic_ns() of the frame
+    def record(self, timestamp, event: str, value: int = 0, code=None, rssi=None):
+        t = epoch_seconds(timestamp)
+        state = self.state
+        state.event = event
+        state.timestamp = t
+        state.count += 1
+        if code is not None:
+            state.code = code
+        if rssi is not None:
+            state.rssi = rssi
+        if self.history is None:
+            self.history = EventHistory(self.history_size)
+        self.history.append(t, event, value)
+
     def get_state(self):
-        return 'OK'
+        return self.state.to_dict()
+
+    # returns the recent events between start and end (seconds since the epoch)
+    def get_history(self, start=None, end=None):
+        if self.history is None:
+            return []
+        return [{'timestamp': t, 'event': event, 'value': value} for t, event, value in self.history.query(start, end)]
 
 
 # base class for all device types
 class DeviceType:
+    # frames that do not match the signature are never handed to parse()
+    # None means that every frame is a candidate
+    signature = None
+
+    # transmit settings used by the scheduler: a lower priority is sent first,
+    # every command is sent tx_repeats times with tx_gap seconds in between
+    tx_priority = 10
+    tx_repeats = 1
+    tx_gap = 0.0
+
+    # repeated transmissions of a decoded frame within this many seconds are dropped
+    dedup_window = 0.5
+
     def __init__(self, type_name, commands):
         self.type_name = type_name
-        self.instances = []
+        # instances and index are copy-on-write snapshots: they are replaced
+        # but never modified, so the receive path can use them without locking
+        self.instances = ()
+        self.index = {}
         self.commands = commands
+        self.__lock = threading.RLock()
+        self.__staged = None  # (instances, index) during a bulk update
+        # incremented whenever the instances change
+        self.version = 0
+        # set by the gateway, decoded events are published here
+        self.event_bus = None
+        self.deduplicator = Deduplicator(self.dedup_window)
 
     def add_instance(self, instance):
-        self.instances.append(instance)
+        with self.__lock:
+            if instance.key in self.index or (self.__staged is not None and instance.key in self.__staged[1]):
+                raise Exception('Device instance already exists')
+            if self.__staged is not None:
+                self.__staged[0].append(instance)
+                self.__staged[1][instance.key] = instance
+                return
+            index = self.index.copy()
+            index[instance.key] = instance
+            self.index = index
+            self.instances = self.instances + (instance,)
+            self.version += 1
+
+    # instances added within this context are published in one snapshot
+    @contextlib.contextmanager
+    def bulk_update(self):
+        with self.__lock:
+            self.__staged = ([], {})
+            try:
+                yield
+            finally:
+                instances, index = self.__staged
+                self.__staged = None
+                if instances:
+                    self.index = {**self.index, **index}
+                    self.instances = self.instances + tuple(instances)
+                    self.version += 1
+
+    # converts an instance id as used by the API into the native key
+    def to_key(self, instance_id):
+        return instance_id
 
     def parse(self, timestamp, pulses):
         return False
 
-    def get_instance(self, instance_id):
-        for i in self.instances:
-            if i.get_id() == instance_id:
-                return i
-        raise Exception( 'No such device instance')
+    # called by the gateway in asyncio mode, types that need to await
+    # something while handling a frame can override this
+    async def parse_async(self, timestamp, pulses):
+        return self.parse(timestamp, pulses)
+
+    # called when the gateway stops
+    def close(self):
+        pass
 
+    # publishes a decoded event of the instance with the given (native) id
+    def publish(self, timestamp, instance_id, event: str, **data):
+        if self.event_bus is not None:
+            self.event_bus.publish(Event(self.type_name, str(instance_id), event, to_datetime(timestamp), data))
+
+    # returns the instance for a native key or None
+    def lookup(self, key):
+        return self.index.get(key)
+
+    def get_instance(self, instance_id):
+        try:
+            instance = self.index.get(self.to_key(instance_id))
+        except ValueError:
+            instance = None
+        if instance is None:
+            raise Exception('No such device instance')
+        return instance
+
+    # creates and adds an instance, returns the new instance
     def new_instance(self, parameters: {}):
         pass
 
@@ -53,15 +189,15 @@ class DeviceType:
 
 
 # this class handles all unknown messages
+# counts the frames no other device type recognized, see Fingerprint.SignalIndex
 class UnknownDeviceType(DeviceType):
     def __init__(self):
         DeviceType.__init__(self, "Unknown", [])
+        self.signals = SignalIndex()
 
     def add_instance(self):
         raise Exception("should not be used")
 
     def parse(self, timestamp, pulses):
-        s = ",".join([str(i) for i in pulses])
-        msg = "{dt} Unknown: {msg}".format(dt=timestamp, msg=s)
-        logging.info(msg)
+        self.signals.add(pulses, timestamp)
         return True
@@ -0,0 +1,38 @@
+# Pre-selects the device types that can possibly parse a frame.
+# The candidates are indexed by pulse count, so the per-frame work does not
+# grow with the number of device types that are loaded. Only the types that
+# accept the pulse count are checked against their duration and header.
+class DispatchIndex:
+    def __init__(self, device_types):
+        self.device_types = list(device_types)
+        self.by_count = {}
+        self.wildcards = ()
+        self.__build()
+
+    def __build(self):
+        # types without a (bounded) pulse count range are candidates for every frame
+        wildcards = []
+        counts = set()
+        for dt in self.device_types:
+            signature = dt.signature
+            if signature is None or signature.max_pulses is None:
+                wildcards.append(dt)
+            else:
+                counts.update(range(signature.min_pulses, signature.max_pulses + 1))
+
+        # keep the order of the device types, the unknown device type must stay last
+        for count in counts:
+            self.by_count[count] = tuple(
+                (dt, dt.signature) for dt in self.device_types
+                if dt in wildcards or dt.signature.min_pulses <= count <= dt.signature.max_pulses)
+        self.wildcards = tuple((dt, dt.signature) for dt in wildcards)
+
+    # pulses is a Framer.Frame, its length is shared with the parsers
+    def candidates(self, pulses):
+        entries = self.by_count.get(len(pulses), self.wildcards)
+        if not entries:
+            return
+        length = pulses.length
+        for dt, signature in entries:
+            if signature is None or signature.matches(pulses, length):
+                yield dt
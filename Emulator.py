@@ -0,0 +1,209 @@
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+import RFLinkTools
+from RA20RF import RA20RFInstance
+from SomfyRTS import SomfyRemoteInstance
+
+
+# "r:<count>:p1,p2,..." line of a received frame
+def frame_line(pulses):
+    return ('r:{n}:'.format(n=len(pulses)) + ','.join(str(p) for p in pulses) + '\n').encode('utf-8')
+
+
+# the received pulses of a transmitted frame: without the control values
+def ra20rf_pulses(device_id):
+    return RA20RFInstance(device_id).alarm().pulses[2:]
+
+
+def somfy_pulses(remote, code, button='up'):
+    instance = SomfyRemoteInstance(code - 1, remote)
+    return getattr(instance, button)().pulses[2:]
+
+
+# Generates the lines an RFLink-alt stick sends on a busy band. mix gives the
+# relative share of every kind of line:
+#   ra20rf   a valid RA20RF frame of one of the ra20rf_ids
+#   somfy    a valid Somfy RTS frame of one of the somfy_remotes, with a new code
+#   repeat   the previous frame again, as a remote repeats a frame
+#   unknown  a frame with random pulses
+#   garbage  a frame with corrupted numbers, or a line that is no frame at all
+class Traffic:
+    mix = {'ra20rf': 1, 'somfy': 4, 'repeat': 3, 'unknown': 2, 'garbage': 1}
+
+    def __init__(self, mix=None, ra20rf_ids=(42,), somfy_remotes=(983297,), seed=None):
+        self.random = random.Random(seed)
+        mix = mix or self.mix
+        self.kinds = list(mix)
+        self.weights = [mix[k] for k in self.kinds]
+        self.ra20rf_ids = list(ra20rf_ids)
+        self.somfy_remotes = list(somfy_remotes)
+        self.codes = {remote: 1 for remote in self.somfy_remotes}
+        # RA20RF frames only depend on the id
+        self.ra20rf_lines = {i: frame_line(ra20rf_pulses(i)) for i in self.ra20rf_ids}
+        self.previous = None
+
+    # returns (kind, line), a frame is a line that starts with r:
+    def next(self):
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        if kind == 'repeat' and self.previous is not None:
+            return kind, self.previous
+        if kind == 'ra20rf' and self.ra20rf_ids:
+            line = self.ra20rf_lines[self.random.choice(self.ra20rf_ids)]
+        elif kind == 'somfy' and self.somfy_remotes:
+            remote = self.random.choice(self.somfy_remotes)
+            self.codes[remote] += 1
+            line = frame_line(somfy_pulses(remote, self.codes[remote], self.random.choice(['up', 'down', 'stop'])))
+        elif kind == 'garbage':
+            if self.random.random() < 0.5:
+                return kind, b'20;00;Nodo RadioFrequencyLink - RFLink Gateway V1.1 - R46;\n'
+            return kind, b'r:9:120,x80,,400,' + bytes(self.random.randrange(256) for _ in range(8)).replace(b'\n', b'') + b'\n'
+        else:
+            kind = 'unknown'
+            line = frame_line([self.random.randrange(20, 3000) for _ in range(self.random.randrange(8, 120))])
+        self.previous = line
+        return kind, line
+
+
+# Emulates an RFLink-alt stick on a pseudo terminal. The gateway opens
+# port like a serial port. Written lines are the frames the stick received,
+# the t: messages the gateway sends are captured with their time.
+# Like a UART without flow control, a line that cannot be written because
+# the gateway does not read fast enough is dropped.
+# With binary the stick answers "c:?" with "c:binary" and the gateway sends
+# binary messages, see RFLinkTools.encode_binary. They are captured as the
+# t: message with the same pulses.
+class Emulator:
+    def __init__(self, binary=False):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.binary = binary
+
+        self.transmitted = []  # (time.monotonic(), t: message)
+        self.condition = threading.Condition()
+        # bytes of the captured messages as they were sent
+        self.transmitted_bytes = 0
+        # called with every other line the gateway writes, returns the reply or None
+        self.on_command = None
+
+        self.dropped = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, name='Emulator', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    # writes a line, or part of it, returns False when it was dropped
+    def write(self, data):
+        try:
+            n = os.write(self.master, data)
+        except BlockingIOError:
+            self.dropped += 1
+            return False
+        view = memoryview(data)[n:]
+        while len(view) > 0:
+            select.select([], [self.master], [])
+            try:
+                view = view[os.write(self.master, view):]
+            except BlockingIOError:
+                pass
+        return True
+
+    # writes lines at rate lines per second for duration seconds (or until the
+    # lines run out), split is the share of lines written in two parts
+    # returns the lines that were written
+    def inject(self, lines, rate, duration=None, split=0.0, seed=None):
+        rnd = random.Random(seed)
+        interval = 1.0 / rate
+        start = time.monotonic()
+        written = []
+        for n, line in enumerate(lines):
+            due = start + n * interval
+            if duration is not None and due - start >= duration:
+                break
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if split and rnd.random() < split and len(line) > 2:
+                cut = rnd.randrange(1, len(line) - 1)
+                if self.write(line[:cut]):
+                    time.sleep(0.001)
+                    if self.write(line[cut:]):
+                        written.append(line)
+            elif self.write(line):
+                written.append(line)
+        return written
+
+    # waits for a t: message captured at or after since, returns (time, message) or None
+    def wait_transmit(self, since, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                found = self.__first_since(since)
+                if found is not None:
+                    return found
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def __first_since(self, since):
+        found = None
+        for t, message in reversed(self.transmitted):
+            if t < since:
+                break
+            found = (t, message)
+        return found
+
+    def __run(self):
+        pending = b''
+        while self.running:
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            try:
+                data = os.read(self.master, 65536)
+            except (BlockingIOError, OSError):
+                continue
+            now = time.monotonic()
+            pending += data
+            while pending:
+                if pending[0:1] == RFLinkTools.binary_marker:
+                    message = RFLinkTools.decode_binary(pending)
+                    if message is None:
+                        break
+                    pulses, size = message
+                    self.__transmitted(now, ('t:' + RFLinkTools.pulses_to_string(pulses) + '\n').encode('utf-8'), size)
+                    pending = pending[size:]
+                else:
+                    eol = pending.find(b'\n')
+                    if eol < 0:
+                        break
+                    self.__received(now, pending[:eol + 1])
+                    pending = pending[eol + 1:]
+
+    def __transmitted(self, now, message, size):
+        with self.condition:
+            self.transmitted.append((now, message))
+            self.transmitted_bytes += size
+            self.condition.notify_all()
+
+    def __received(self, now, line):
+        if line.startswith(b't:'):
+            self.__transmitted(now, line, len(line))
+        elif line == b'c:?\n' and self.binary:
+            self.write(b'c:binary\n')
+        elif self.on_command is not None:
+            reply = self.on_command(line)
+            if reply is not None:
+                self.write(reply)
@@ -0,0 +1,85 @@
+import json
+import threading
+from collections import deque
+
+
+# a decoded RF event, serialized once no matter how many subscribers there are
+class Event:
+    __slots__ = ('device_type', 'id', 'event', 'timestamp', 'data', '__sse')
+
+    def __init__(self, device_type: str, id: str, event: str, timestamp=None, data=None):
+        self.device_type = device_type
+        self.id = id
+        self.event = event
+        self.timestamp = timestamp
+        self.data = data or {}
+        self.__sse = None
+
+    def to_dict(self):
+        return {'device_type': self.device_type,
+                'id': self.id,
+                'event': self.event,
+                'timestamp': None if self.timestamp is None else self.timestamp.isoformat(),
+                'data': self.data}
+
+    # server-sent event message
+    def sse(self):
+        if self.__sse is None:
+            self.__sse = 'event: {event}\ndata: {data}\n\n'.format(event=self.event,
+                                                                   data=json.dumps(self.to_dict())).encode('utf-8')
+        return self.__sse
+
+
+# a bounded queue of events for one consumer
+# publishing never blocks: when the consumer cannot keep up the oldest events are dropped
+class Subscription:
+    def __init__(self, bus, maxsize: int, device_type=None):
+        self.bus = bus
+        self.device_type = device_type
+        self.events = deque(maxlen=maxsize)
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def put(self, event):
+        if self.device_type is not None and event.device_type != self.device_type:
+            return
+        with self.condition:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            self.condition.notify()
+
+    # returns the next event, or None after timeout seconds
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+                if not self.events:
+                    return None
+            return self.events.popleft()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+# fans out the events published by the device types to all subscribers
+class EventBus:
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        # copy-on-write, publish() iterates without locking
+        self.subscriptions = ()
+        self.lock = threading.Lock()
+
+    def subscribe(self, device_type=None, maxsize=None):
+        subscription = Subscription(self, maxsize or self.maxsize, device_type)
+        with self.lock:
+            self.subscriptions = self.subscriptions + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions = tuple(s for s in self.subscriptions if s is not subscription)
+
+    def publish(self, event):
+        for subscription in self.subscriptions:
+            subscription.put(event)
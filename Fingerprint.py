@@ -0,0 +1,135 @@
+import heapq
+import threading
+from collections import OrderedDict, deque
+import Framer
+from History import to_datetime
+
+
+# pulse length bucket, 4 buckets per octave
+# buckets of neighbouring lengths are consecutive integers
+def bucket(pulse: int):
+    n = pulse.bit_length()
+    if n < 3:
+        return pulse
+    return n << 2 | (pulse >> (n - 3)) & 3
+
+
+# the bucket of every Framer symbol below 65536, a symbol is 1/16 octave
+symbol_buckets = bytes(bucket(bounds[0]) if bounds is not None and bounds[1] is not None else 0
+                       for bounds in Framer.symbol_bounds)
+
+
+# the signature of a frame: the number of pulses and its timing alphabet
+# the alphabet is the list of pulse length clusters, neighbouring buckets are
+# merged so timing jitter around a bucket boundary gives the same signature
+def signature(pulses):
+    if isinstance(pulses, Framer.Frame) and pulses.typecode == 'H':
+        # the buckets of the symbols of the frame
+        buckets = sorted(set(pulses.symbols.translate(symbol_buckets)))
+    else:
+        buckets = sorted({bucket(p) for p in pulses})
+    alphabet = []
+    previous = None
+    for b in buckets:
+        if previous is None or b != previous + 1:
+            alphabet.append(b)
+        previous = b
+    return len(pulses), tuple(alphabet)
+
+
+def similar(a, b):
+    return a[0] == b[0] and len(a[1]) == len(b[1]) and all(abs(x - y) <= 1 for x, y in zip(a[1], b[1]))
+
+
+# pulse length ranges of the clusters in a frame, [(shortest, longest)]
+def timings(pulses):
+    clusters = []
+    for p in sorted(pulses):
+        if clusters and bucket(p) <= bucket(clusters[-1][1]) + 1:
+            clusters[-1][1] = p
+        else:
+            clusters.append([p, p])
+    return [tuple(c) for c in clusters]
+
+
+class SignalEntry:
+    __slots__ = ('signature', 'count', 'first_seen', 'last_seen', 'samples')
+
+    def __init__(self, signature, samples: int):
+        self.signature = signature
+        self.count = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.samples = deque(maxlen=samples)
+
+    def to_dict(self):
+        length, alphabet = self.signature
+        latest = self.samples[-1]
+        return {'signature': '{length}:{alphabet}'.format(length=length, alphabet='.'.join(map(str, alphabet))),
+                'pulses': length,
+                'count': self.count,
+                'first_seen': None if self.first_seen is None else to_datetime(self.first_seen).isoformat(),
+                'last_seen': None if self.last_seen is None else to_datetime(self.last_seen).isoformat(),
+                'timings': timings(latest),
+                'samples': [','.join(map(str, s)) for s in self.samples]}
+
+
+# Counts the frames no device type recognized, by signature.
+# At most capacity signatures are kept, the least recently seen are forgotten
+# first, so a busy band cannot grow the index. The latest frames of every
+# signature are kept as samples.
+class SignalIndex:
+    def __init__(self, capacity: int = 256, samples: int = 3):
+        self.capacity = capacity
+        self.samples = samples
+        self.entries = OrderedDict()  # signature -> SignalEntry, least recently seen first
+        self.total = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def add(self, pulses, timestamp=None):
+        key = signature(pulses)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = SignalEntry(key, self.samples)
+                entry.first_seen = timestamp
+                while len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self.entries.move_to_end(key)
+            entry.count += 1
+            entry.last_seen = timestamp
+            entry.samples.append(pulses)
+            self.total += 1
+
+    # the n most frequent signals, as dicts
+    # a single pulse that jitters around a bucket boundary still splits a signal
+    # over several signatures, signatures that only differ by one bucket per
+    # cluster are reported together with the most frequent one
+    def top(self, n: int = 20):
+        with self.lock:
+            entries = sorted(self.entries.values(), key=lambda e: e.count, reverse=True)
+            groups = []  # [(representative, count, variants)]
+            for entry in entries:
+                for group in groups:
+                    if similar(group[0].signature, entry.signature):
+                        group[1] += entry.count
+                        group[2] += 1
+                        break
+                else:
+                    groups.append([entry, entry.count, 1])
+            result = []
+            for entry, count, variants in heapq.nlargest(n, groups, key=lambda g: g[1]):
+                signal = entry.to_dict()
+                signal['count'] = count
+                signal['variants'] = variants
+                result.append(signal)
+            return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total = 0
+            self.evicted = 0
@@ -0,0 +1,162 @@
+import sys
+from array import array
+
+# Pulse widths are quantized into symbols of 1/16 octave, a symbol is at most
+# 4.4% wide: widths below 16 are a symbol of their own, the widths
+# 16 << e .. (32 << e) - 1 are the symbols 16 * (e + 1) .. 16 * (e + 1) + 15.
+# symbol_bounds[symbol] is the (shortest, longest) width of a symbol, symbol
+# 255 stands for all widths of 65536 and longer.
+symbol_bounds = [(width, width) for width in range(16)]
+for e in range(12):
+    for k in range(16):
+        low = (16 + k) << e
+        symbol_bounds.append((low, low + (1 << e) - 1))
+symbol_bounds += [None] * (255 - len(symbol_bounds)) + [(65536, None)]
+# the symbol of every width below 65536
+symbol_table = bytearray(65536)
+for symbol, bounds in enumerate(symbol_bounds[:-1]):
+    if bounds is not None:
+        low, high = bounds
+        symbol_table[low:high + 1] = bytes([symbol]) * (high + 1 - low)
+symbol_table = bytes(symbol_table)
+
+# Translation tables that quantize the low and high bytes of 16 bit pulses,
+# see Frame.symbols. A table gives 0 where another table gives the symbol.
+low_symbols = symbol_table[:256]  # low byte, when the high byte is 0
+high_zero = b'\xff' + bytes(255)  # high byte: 0xff when it is 0
+high_small = bytes(h if h < 16 else 0 for h in range(256))  # high byte, when it is below 16
+low_top = bytes(b >> 4 for b in range(256))  # top 4 bits of the low byte
+# high byte below 16 << 4 | top 4 bits of the low byte, for pulses of 256 to 4095
+middle_symbols = bytes(symbol_table[m << 4] if m >= 16 else 0 for m in range(256))
+high_symbols = bytes(symbol_table[h << 8] if h >= 16 else 0 for h in range(256))  # high byte of 16 and more
+
+
+# Splits the serial byte stream into lines without losing partial lines.
+# Data is read into a reusable buffer; complete lines are handed out as
+# memoryviews into that buffer, so they are only valid until the next read.
+# A partial line longer than max_line (noise, or a stick at the wrong baud
+# rate) is dropped up to its end of line and counted in dropped.
+class Framer:
+    def __init__(self, size: int = 4096, max_line: int = 8192):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte that has not been handed out
+        self.end = 0  # end of the received data
+        self.scanned = 0  # the bytes from start up to here hold no end of line
+        self.max_line = max_line
+        self.dropped = 0
+        self.discarding = False  # the rest of a dropped line is still coming in
+
+    def __reserve(self, n):
+        if self.end + n <= len(self.buffer):
+            return
+        pending = self.end - self.start
+        if pending + n <= len(self.buffer) // 2:
+            # move the partial line to the front of the buffer
+            self.buffer[0:pending] = self.buffer[self.start:self.end]
+        else:
+            # grow, lines handed out before stay valid in the old buffer
+            buffer = bytearray(2 * (pending + n))
+            buffer[0:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+        self.scanned -= self.start
+        self.start = 0
+        self.end = pending
+
+    # reads everything that is available on the port
+    # blocks until the port timeout when there is nothing to read
+    def read(self, port):
+        n = port.in_waiting or 1
+        self.__reserve(n)
+        count = port.readinto(self.view[self.end:self.end + n])
+        if count:
+            self.end += count
+        return count
+
+    # adds received data
+    def feed(self, data):
+        self.__reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    # yields all complete lines, without the end of line
+    def lines(self):
+        if self.discarding:
+            eol = self.buffer.find(b'\n', self.start, self.end)
+            self.discarding = eol < 0
+            self.start = self.end if eol < 0 else eol + 1
+        while True:
+            eol = self.buffer.find(b'\n', max(self.start, self.scanned), self.end)
+            if eol < 0:
+                break
+            line = self.view[self.start:eol]
+            self.start = eol + 1
+            yield line
+        self.scanned = self.end
+        if self.end - self.start > self.max_line:
+            self.start = self.end
+            self.dropped += 1
+            self.discarding = True
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+
+
+# The pulses of a received frame, quantized once for all the device types
+# that try to parse it. A frame is an array of pulses, the rest is computed
+# when it is first used:
+#   length    total duration
+#   symbols   bytes, the symbol of every pulse, see symbol_bounds
+# A parser classifies the 256 symbols once, when it is created, and then
+# matches the symbols of a frame with bytes operations.
+# Slices of a frame are plain arrays.
+class Frame(array):
+    def __getattr__(self, name):
+        if name == 'length':
+            value = sum(self)
+        elif name == 'symbols':
+            value = self.__symbols()
+        else:
+            raise AttributeError(name)
+        self.__dict__[name] = value
+        return value
+
+    # the symbol of a pulse depends on its high byte and at most the top 4
+    # bits of its low byte, so the symbols of all pulses are computed with a
+    # few translations of the low and high bytes, combined as integers with
+    # a byte per pulse
+    def __symbols(self):
+        if self.typecode != 'H':
+            return bytes(symbol_table[p] if p < 65536 else 255 for p in self)
+        data = self.tobytes()
+        low, high = (data[0::2], data[1::2]) if sys.byteorder == 'little' else (data[1::2], data[0::2])
+        n = len(low)
+        middle = (int.from_bytes(high.translate(high_small), 'little') << 4
+                  | int.from_bytes(low.translate(low_top), 'little')).to_bytes(n, 'little').translate(middle_symbols)
+        symbols = (int.from_bytes(low.translate(low_symbols), 'little') & int.from_bytes(high.translate(high_zero), 'little')
+                   | int.from_bytes(middle, 'little')
+                   | int.from_bytes(high.translate(high_symbols), 'little'))
+        return symbols.to_bytes(n, 'little')
+
+
+# converts a received line into a Frame or None for other messages
+# "r:52:8000,800,800,1600,..." -> Frame('H', [8000, 800, 800, 1600, ...])
+# like the original re.split('[:,]', message)[2:] the first field is skipped
+def parse_pulses(line):
+    if len(line) < 2 or line[0] != ord('r'):
+        return None
+    fields = bytes(line).replace(b':', b',').split(b',')[2:]
+    try:
+        return Frame('H', map(int, fields))
+    except OverflowError:
+        return Frame('I', map(int, fields))
+
+
+# a Frame of a sequence of pulses
+def to_frame(pulses):
+    if isinstance(pulses, Frame):
+        return pulses
+    try:
+        return Frame('H', pulses)
+    except OverflowError:
+        return Frame('I', pulses)
@@ -1,107 +1,502 @@
-import serial
+import asyncio
+import importlib
 import logging
+import os
+import queue
 import signal
-from datetime import datetime
-import re
+import threading
+import time
+import Metrics
 import RFLinkTools
-from tinydb import TinyDB
+import Framer
+import Capture
+import Protocol
+from Transceiver import Transceiver
+from Registry import Registry
+from EventBus import EventBus
 from Device import UnknownDeviceType
+from Dispatch import DispatchIndex
+
+frames = Metrics.counter('rflink_frames_total', 'Received frames by the device type that handled them', ('device_type',))
+invalid_frames = Metrics.counter('rflink_invalid_frames_total', 'Received messages that could not be handled')
+handle_seconds = Metrics.histogram('rflink_handle_seconds', 'Time to dispatch a received message')
+parse_seconds = Metrics.histogram('rflink_parse_seconds', 'Time spent in DeviceType.parse', ('device_type',))
+
+log = logging.getLogger(__name__)
 
 
 class Gateway:
-    def __signal_handler(self, frame):  # TODO - not sure if this is correct
-        logging.info('Gateway exiting gracefully')
-        self.running = False
+    # seconds a request thread waits for a command to be sent
+    send_timeout = 5.0
+    # database of earlier versions, imported when the registry is empty
+    tinydb_filename = './gateway.db'
+
+    def __signal_handler(self, signum, frame):
+        log.info('Gateway exiting gracefully')
+        self.stop()
 
     def __init__(self):
-        self.serial_port = None
+        # the RFLink-alt sticks, opened by run or run_async
+        # every transceiver queues and sends its own commands
+        self.transceivers = []
+        self.transceiver_index = {}
 
         self.running = True
 
-        self.filename = './gateway.db'
-        self.db = TinyDB(self.filename)
-        self.device_type_table = self.db.table('device_type')
+        # asyncio mode, see run_async
+        self.loop = None
+        self.tasks = []
+
+        # the received frames are appended to this capture, see record
+        self.capture = None
+
+        self.filename = './gateway.sqlite'
+        self.registry = Registry(self.filename)
+        if self.registry.is_empty() and os.path.exists(self.tinydb_filename):
+            self.registry.import_tinydb(self.tinydb_filename)
+
+        # decoded events of all device types
+        self.events = EventBus()
 
         # set-up the basic device administration
         self.device_types = [UnknownDeviceType()]
+        # incremented whenever a device type is added, see get_version
+        self.version = 0
+        self.device_type_index = {dt.type_name: dt for dt in self.device_types}
+
+        types, instances = self.registry.load()
+        for device_module, device_type in types:
+            self._add_device_type_instance(device_module=device_module, device_type=device_type, update_dispatch=False)
+        self.dispatch = DispatchIndex(self.device_types)
+        by_type = {}
+        for type_name, instance_id, parameters in instances:
+            by_type.setdefault(type_name, []).append(parameters)
+        for type_name, parameter_list in by_type.items():
+            dt = self.get_device_type(type_name)
+            if dt is None:
+                log.error('Device instances with an unknown device type {type}'.format(type=type_name))
+                continue
+            with dt.bulk_update():
+                for parameters in parameter_list:
+                    try:
+                        self.__new_instance(dt, parameters)
+                    except Exception as e:
+                        log.error('Could not load {type} instance {parameters}: {error}'.format(
+                            type=type_name, parameters=parameters, error=e))
 
-        for dt in self.device_type_table.all():
-            self._add_device_type_instance(device_module=dt['device_module'], device_type=dt['device_type'])
+        # named groups of device instances: name -> [(type_name, instance_id)]
+        self.groups = self.registry.load_groups()
 
         signal.signal(signal.SIGINT, self.__signal_handler)
 
-    def _add_device_type_instance(self, device_module, device_type):
-        matches = [dt for dt in self.device_types if type(dt).__name__ == device_type]
+    def _add_device_type_instance(self, device_module, device_type, update_dispatch=True):
+        matches = [dt for dt in self.device_types if type(dt).__name__ == device_type or dt.type_name == device_type]
 
         if len(matches) == 0:
-            device_type_module = __import__(device_module)
-            device_type_class = getattr(device_type_module, device_type)
-            device_type_instance = device_type_class()
+            if device_module == 'protocols':
+                # a device type without a python module, see Protocol.load_device_type
+                device_type_instance = Protocol.load_device_type(device_type)
+            else:
+                device_type_module = importlib.import_module(device_module)
+                device_type_class = getattr(device_type_module, device_type)
+                device_type_instance = device_type_class()
+            device_type_instance.event_bus = self.events
             # the unknown device type should always be the last
             i = max(len(self.device_types) - 1, 0)
             self.device_types.insert(i, device_type_instance)
-            logging.info('Added device type {module}.{type}, id={id}'.format(module=device_module, type=device_type, id=i))
+            self.device_type_index = {dt.type_name: dt for dt in self.device_types}
+            self.version += 1
+            if update_dispatch:
+                self.dispatch = DispatchIndex(self.device_types)
+            log.info('Added device type {module}.{type}, id={id}'.format(module=device_module, type=device_type, id=i))
             return i
         else:
             raise Exception('Cannot add second instance of same device type')
 
     def add_device_type(self, device_module, device_type):
         i = self._add_device_type_instance(device_module, device_type)
-        self.device_type_table.insert({'id': str(i), 'device_module': device_module, 'device_type': device_type})
+        self.registry.add_device_type(device_module, device_type, i)
+
+    # creates a device instance and stores it with its parameters
+    def add_device_instance(self, device_type_name, parameters):
+        dt = self.get_device_type(device_type_name)
+        if dt is None:
+            raise Exception('no such device type')
+        parameters = dict(parameters)
+        if parameters.get('transmitter') == '':
+            del parameters['transmitter']
+        instance = self.__new_instance(dt, parameters)
+        self.registry.add_instance(dt.type_name, instance.get_id(), parameters)
+        return instance
+
+    # the optional transmitter parameter pins the instance to a transceiver
+    def __new_instance(self, dt, parameters):
+        instance = dt.new_instance(parameters)
+        if parameters.get('transmitter'):
+            instance.transmitter = parameters['transmitter']
+        return instance
 
     def get_device_type(self, device_type_name):
+        return self.device_type_index.get(device_type_name)
+
+    # changes whenever a device type or device instance is added
+    def get_version(self):
+        return self.version + sum(dt.version for dt in self.device_types)
+
+    # the transceiver that sends a command: the one the instance is pinned to,
+    # the one a command of the same device is still queued on, or else the one
+    # with the shortest queue. Pinned instances fall back to the others when their
+    # transceiver is not connected.
+    def __transceiver(self, instance, key):
+        transceivers = self.transceivers
+        if not transceivers:
+            raise Exception('no transceiver')
+        if instance.transmitter is not None:
+            transceiver = self.transceiver_index.get(instance.transmitter)
+            if transceiver is not None:
+                return transceiver
+        if len(transceivers) == 1:
+            return transceivers[0]
+        for transceiver in transceivers:
+            if transceiver.scheduler.is_pending(key[:-1]):
+                return transceiver
+        return min(transceivers, key=lambda t: t.scheduler.depth())
+
+    # number of commands waiting on all transceivers
+    def transmit_depth(self):
+        return sum(t.scheduler.depth() for t in self.transceivers)
+
+    def transmit_stats(self):
+        return {t.name: t.scheduler.stats() for t in self.transceivers}
+
+    # adds device instances, given as (type_name, instance_id), to a named group
+    def add_group(self, name, members):
+        members = [(type_name, str(instance_id)) for type_name, instance_id in members]
+        for type_name, instance_id in members:
+            dt = self.get_device_type(type_name)
+            if dt is None:
+                raise Exception('no such device type')
+            dt.get_instance(instance_id)
+        self.registry.add_group_members(name, members)
+        group = self.groups.get(name, [])
+        self.groups[name] = group + [m for m in members if m not in group]
+
+    # returns the (device type, instance) pairs a batch item refers to
+    def __targets(self, item):
+        if 'group' in item:
+            members = self.groups.get(item['group'])
+            if members is None:
+                raise Exception('no such group')
+        else:
+            members = [(item.get('device_type'), item.get('id'))]
+        targets = []
+        for type_name, instance_id in members:
+            dt = self.get_device_type(type_name)
+            if dt is None:
+                raise Exception('no such device type')
+            if instance_id == '*':
+                targets += [(dt, instance) for instance in dt.instances]
+            else:
+                targets.append((dt, dt.get_instance(str(instance_id))))
+        return targets
+
+    # executes a batch of commands and queues them as one ordered burst
+    # an item is {'device_type': .., 'id': .., 'command': ..}, where id '*' is every
+    # instance of the type, or {'group': .., 'command': ..}
+    # returns a result per device instance and a future per queued command
+    def commands(self, items):
+        started = time.monotonic_ns()
+
+        # validate everything before anything is executed
+        results = []
+        planned = []
+        for item in items:
+            command = item.get('command')
+            try:
+                targets = self.__targets(item)
+            except Exception as e:
+                results.append({'device_type': item.get('device_type'), 'id': item.get('id'),
+                                'group': item.get('group'), 'command': command, 'result': False, 'error': str(e)})
+                continue
+            for dt, instance in targets:
+                result = {'device_type': dt.type_name, 'id': instance.get_id(), 'command': command,
+                          'result': False, 'error': ''}
+                results.append(result)
+                if command not in dt.get_commands() or getattr(instance, command, None) is None:
+                    result['error'] = 'no such command'
+                else:
+                    planned.append((result, dt, instance, command))
+
+        # encode all commands in one pass, one burst per transceiver
+        # the unpinned commands of a batch all go to the same transceiver, in order
+        # a command that is coalesced, with a queued job or an earlier job of the
+        # batch, is not encoded
+        batches = {}  # transceiver -> ([job], [(result, dt)])
+        latest = {}  # (transceiver, device) -> the last job of the batch
+        submitted = []
+        for result, dt, instance, command in planned:
+            key = (dt.type_name, instance.key, command)
+            try:
+                transceiver = self.__transceiver(instance, key)
+                job = latest.get((transceiver, key[:-1]))
+                if job is None:
+                    future = transceiver.scheduler.coalesce(key)
+                    if future is not None:
+                        submitted.append((result, future))
+                        continue
+                if job is not None and job[3] == key:
+                    frame = job[0]
+                else:
+                    frame = getattr(instance, command)()
+            except Exception as e:
+                result['error'] = str(e)
+                continue
+            if not isinstance(frame, RFLinkTools.TxFrame):
+                frame = RFLinkTools.TxFrame(frame)
+            jobs, queued = batches.setdefault(transceiver, ([], []))
+            job = (frame, dt.tx_repeats, dt.tx_gap, key)
+            latest[(transceiver, key[:-1])] = job
+            jobs.append(job)
+            queued.append((result, dt))
+
+        for transceiver, (jobs, queued) in batches.items():
+            priority = min(dt.tx_priority for result, dt in queued)
+            futures = transceiver.scheduler.submit_batch(jobs, priority=priority, started=started)
+            submitted += [(result, future) for (result, dt), future in zip(queued, futures)]
+        return results, submitted
+
+    # executes a command on a device instance and queues the resulting pulses
+    # returns a future that completes when the command has been sent
+    def command(self, device_type_name, instance_id, command):
+        dt = self.get_device_type(device_type_name)
+        if dt is None:
+            raise Exception('no such device type')
+        started = time.monotonic_ns()
+        instance = dt.get_instance(instance_id)
+        key = (dt.type_name, instance.key, command)
+        transceiver = self.__transceiver(instance, key)
+        # a coalesced command is not executed, so it does not use a rolling code
+        future = transceiver.scheduler.coalesce(key)
+        if future is not None:
+            return future
+        frame = dt.execute_command(instance_id, command)
+        if not isinstance(frame, RFLinkTools.TxFrame):
+            frame = RFLinkTools.TxFrame(frame)
+        return transceiver.scheduler.submit(frame, priority=dt.tx_priority, repeats=dt.tx_repeats, gap=dt.tx_gap,
+                                            key=key, started=started)
+
+    def __open(self, com_ports):
+        if isinstance(com_ports, str):
+            com_ports = [com_ports]
+        self.transceivers = [Transceiver(com_port) for com_port in com_ports]
+        self.transceiver_index = {t.name: t for t in self.transceivers}
+
+    def __close(self):
+        for transceiver in self.transceivers:
+            transceiver.close()
+        self.close()
+
+    # stops recording and closes the device types, e.g. stores the rolling codes
+    def close(self):
+        self.stop_recording()
         for dt in self.device_types:
-            if dt.type_name == device_type_name:
-                return dt
-        return None
-
-    def __del__(self):
-        if not (self.serial_port is None):
-            logging.debug('Closing COM port: ' + self.serial_port)
-            self.serial_port.close()
-
-    def step(self, message):
-        data = self.serial_port.readline()
-        if len(data) > 0:
-            message += data.decode('utf-8')
-            eol = message[-1]
-            if eol == '\n':
-                # complete message: share with devices
-                logging.debug('recv: ' + message)
-                self.__handle_message(message)
-                message = ''
-        return message
-
-    def run(self, com_port: str):
-        logging.info('Opening COM port ' + com_port)
-        self.serial_port = serial.Serial(com_port, 57600, timeout=0.1)
-
-        message = ''
+            dt.close()
+
+    # reads and handles the received messages of one transceiver
+    def step(self, transceiver):
+        # partial lines stay in the framer until the rest is received
+        for line in transceiver.read():
+            # complete message: share with devices
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('recv: %s', line.tobytes())
+            self.__handle_message(line)
+
+    # com_ports is a serial port or a list of them, one per RFLink-alt stick
+    def run(self, com_ports):
+        self.__open(com_ports)
+        try:
+            for transceiver in self.transceivers:
+                transceiver.open()
+            if len(self.transceivers) == 1:
+                while self.running:
+                    self.step(self.transceivers[0])
+            else:
+                # a reader thread per port, the messages of all ports are handled
+                # by this thread, so the devices see a single stream of frames
+                received = queue.Queue()
+                readers = [threading.Thread(target=self.__read_port, args=(transceiver, received),
+                                            name='Reader ' + transceiver.name, daemon=True)
+                           for transceiver in self.transceivers]
+                for reader in readers:
+                    reader.start()
+                while self.running:
+                    try:
+                        line = received.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    self.__handle_message(line)
+                for reader in readers:
+                    reader.join()
+        finally:
+            self.__close()
+        log.debug('Gateway run stopped')
+
+    def __read_port(self, transceiver, received):
         while self.running:
-            self.step(message)
+            for line in transceiver.read():
+                # copied, the line is only valid until the next read
+                line = line.tobytes()
+                log.debug('recv on %s: %s', transceiver.name, line)
+                received.put(line)
 
-        self.serial_port.close()
-        logging.debug('Gateway run stopped')
+    # appends every received frame to a capture file, see Capture
+    # compress: gzip, by default when the filename ends with .gz
+    def record(self, filename, compress=None):
+        self.stop_recording()
+        self.capture = Capture.Writer(filename, compress)
+        log.info('Recording received frames to {filename}'.format(filename=filename))
 
-    def send(self, pulses):
-        p_str = 't:' + RFLinkTools.pulses_to_string(pulses) + '\n'
-        logging.info('Sending command: ' + p_str)
-        self.serial_port.write(p_str.encode('utf-8'))
+    def stop_recording(self):
+        capture = self.capture
+        if capture is not None:
+            self.capture = None
+            capture.close()
+            log.info('Recorded {count} frames to {filename}'.format(count=capture.count, filename=capture.filename))
 
-    def __handle_message(self, message):
-        # received messages start with 'r'
-        if message[0] == 'r':
-            now = datetime.now()
-            try:
-                m = re.split('[:,]', message)[2:]
-                pulses = [int(s) for s in m]
-                for d in self.device_types:
-                    if d.parse(now, pulses):
+    # handles the frames of a capture as if they were received, with the
+    # original time between the frames or, with realtime False, as fast as
+    # possible. Waits longer than max_gap seconds, e.g. between the sessions
+    # of a capture that was appended to, are shortened to max_gap.
+    # returns the number of frames
+    def replay(self, filename, realtime=True, max_gap=10.0):
+        # a replay is not recorded again
+        capture, self.capture = self.capture, None
+        count = 0
+        try:
+            previous = None
+            start = time.monotonic_ns()
+            offset = 0  # replay time - capture time
+            for timestamp, pulses in Capture.read(filename):
+                if not self.running:
+                    break
+                if realtime:
+                    if previous is None or not 0 <= timestamp - previous <= max_gap * 1e9:
+                        # first frame or a jump in the capture time
+                        offset = time.monotonic_ns() - timestamp
+                    previous = timestamp
+                    delay = (timestamp + offset - time.monotonic_ns()) / 1e9
+                    if delay > 0:
+                        time.sleep(delay)
+                self.__handle_message(b'r:%d:%s' % (len(pulses), b','.join(b'%d' % p for p in pulses)))
+                count += 1
+        finally:
+            self.capture = capture
+        log.info('Replayed {count} frames of {filename} in {seconds:.3f}s'.format(
+            count=count, filename=filename, seconds=(time.monotonic_ns() - start) / 1e9))
+        return count
+
+    def stop(self):
+        self.running = False
+        for transceiver in self.transceivers:
+            transceiver.scheduler.stop()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.__cancel_tasks)
+
+    def __cancel_tasks(self):
+        for task in self.tasks:
+            task.cancel()
+
+    # asyncio mode: a task per port reads and dispatches frames, a task per port
+    # writes its queued commands, so the serial ports are only used from the event loop.
+    # a com port can also be a pyserial URL, e.g. socket://localhost:7777
+    async def run_async(self, com_ports):
+        self.__open(com_ports)
+        self.loop = asyncio.get_running_loop()
+        try:
+            for transceiver in self.transceivers:
+                self.tasks.append(transceiver.open_async(self.loop))
+                self.tasks.append(self.loop.create_task(self.__reader(transceiver)))
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop = None
+            self.tasks = []
+            for transceiver in self.transceivers:
+                transceiver.close_async()
+            self.close()
+            log.debug('Gateway run stopped')
+
+    async def __reader(self, transceiver):
+        async for line in transceiver.lines_async():
+            if not self.running:
+                break
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('recv on %s: %s', transceiver.name, line.tobytes())
+            await self.__handle_message_async(line)
+
+    # handles a received message in the threaded mode: hands its frame to the
+    # device types until one of them handled it
+    # frames are timestamped with time.monotonic_ns(), see History.epoch_seconds
+    def __handle_message(self, line):
+        now = time.monotonic_ns()
+        try:
+            pulses = self.__frame(line, now)
+            if pulses is not None:
+                timed = Metrics.enabled
+                for d in self.dispatch.candidates(pulses):
+                    t = time.monotonic_ns() if timed else 0
+                    handled = d.parse(now, pulses)
+                    if timed:
+                        self.__parsed(d, t, handled)
+                    if handled:
                         # message has been handled
                         # Note that the unknown device should always be at the end of this list
                         break
-            except Exception as e:
-                logging.debug('Invalid message')
+        except Exception as e:
+            self.__invalid(e)
+        if Metrics.enabled:
+            handle_seconds.observe_since(now)
+
+    # the same in the asyncio mode, awaits parse_async
+    async def __handle_message_async(self, line):
+        now = time.monotonic_ns()
+        try:
+            pulses = self.__frame(line, now)
+            if pulses is not None:
+                timed = Metrics.enabled
+                for d in self.dispatch.candidates(pulses):
+                    t = time.monotonic_ns() if timed else 0
+                    handled = await d.parse_async(now, pulses)
+                    if timed:
+                        self.__parsed(d, t, handled)
+                    if handled:
+                        break
+        except Exception as e:
+            self.__invalid(e)
+        if Metrics.enabled:
+            handle_seconds.observe_since(now)
+
+    # the frame of a received message, None for other messages
+    # received frames are appended to the capture, see record
+    def __frame(self, line, now):
+        # received messages start with 'r'
+        pulses = Framer.parse_pulses(line)
+        if pulses is not None and self.capture is not None:
+            self.capture.write(pulses, now)
+        return pulses
+
+    @staticmethod
+    def __parsed(d, start, handled):
+        parse_seconds.observe_since(start, d.type_name)
+        if handled:
+            frames.inc(d.type_name)
+
+    @staticmethod
+    def __invalid(e):
+        if Metrics.enabled:
+            invalid_frames.inc()
+        log.debug('Invalid message: %s', e)
 
     # def load(self, filename):
     #     self.filename = filename
@@ -0,0 +1,81 @@
+import time
+from array import array
+from datetime import datetime
+
+# received frames are timestamped with time.monotonic_ns(), they are converted
+# to seconds since the epoch only when an event is recorded or shown
+def epoch_seconds(timestamp):
+    return (timestamp + time.time_ns() - time.monotonic_ns()) / 1e9
+
+
+def to_datetime(timestamp):
+    return datetime.fromtimestamp(epoch_seconds(timestamp))
+
+
+# event names are stored as small integers, names are interned here
+event_names = []
+event_codes = {}
+
+
+def event_code(name: str):
+    code = event_codes.get(name)
+    if code is None:
+        code = len(event_names)
+        if code > 0xFFFF:
+            raise Exception('too many event names')
+        event_names.append(name)
+        event_codes[name] = code
+    return code
+
+
+# the latest known state of a device instance
+class InstanceState:
+    __slots__ = ('event', 'timestamp', 'code', 'rssi', 'count')
+
+    def __init__(self):
+        self.event = None  # name of the last event
+        self.timestamp = None  # seconds since the epoch
+        self.code = None  # rolling code, if the protocol has one
+        self.rssi = None  # signal strength, if the receiver reports it
+        self.count = 0  # number of events
+
+    def to_dict(self):
+        return {'event': self.event, 'timestamp': self.timestamp, 'code': self.code, 'rssi': self.rssi,
+                'count': self.count}
+
+
+# fixed size ring buffer of the most recent events of a device instance
+# every event takes 18 bytes: a timestamp, an event code and an integer value
+class EventHistory:
+    __slots__ = ('times', 'events', 'values', 'head', 'length')
+
+    def __init__(self, size: int = 64):
+        self.times = array('d', bytes(8 * size))
+        self.events = array('H', bytes(2 * size))
+        self.values = array('q', bytes(8 * size))
+        self.head = 0  # next position to write
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, timestamp: float, event: str, value: int = 0):
+        i = self.head
+        self.times[i] = timestamp
+        self.events[i] = event_code(event)
+        self.values[i] = value
+        self.head = (i + 1) % len(self.times)
+        if self.length < len(self.times):
+            self.length += 1
+
+    # returns (timestamp, event, value) tuples with start <= timestamp <= end, oldest first
+    def query(self, start=None, end=None):
+        size = len(self.times)
+        first = (self.head - self.length) % size
+        result = []
+        for n in range(self.length):
+            i = (first + n) % size
+            t = self.times[i]
+            if (start is None or t >= start) and (end is None or t <= end):
+                result.append((t, event_names[self.events[i]], self.values[i]))
+        return result
@@ -0,0 +1,25 @@
+import json
+import threading
+from flask import Response, request
+
+
+# Pre-serialized JSON responses of the read endpoints.
+# A response is rebuilt only when the version of the data it was built from
+# changed. The version is also the ETag, so clients can revalidate with
+# If-None-Match and get a 304 without a body.
+class JsonCache:
+    def __init__(self):
+        self.entries = {}  # key -> (version, body, etag)
+        self.lock = threading.Lock()
+
+    # build() returns the JSON data for the given version of the key
+    def response(self, key, version, build):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            body = json.dumps(build()).encode('utf-8')
+            entry = (version, body, '{key}-{version}'.format(key=abs(hash(key)), version=version))
+            with self.lock:
+                self.entries[key] = entry
+        response = Response(entry[1], mimetype='application/json')
+        response.set_etag(entry[2])
+        return response.make_conditional(request)
@@ -0,0 +1,91 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+# Passes at most rate records per second per logger, with bursts of up to
+# burst records. Every module logs to its own logger, so a protocol that is
+# flooding the band cannot drown the messages of the others. Warnings and
+# errors always pass. The next record that passes reports how many records
+# were suppressed.
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate: float = 10.0, burst: int = 20):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # logger name -> [tokens, time, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(record.name)
+            if bucket is None:
+                bucket = self.buckets[record.name] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed = bucket[2]
+            bucket[2] = 0
+        if suppressed:
+            record.msg = str(record.msg) + ' ({n} similar messages suppressed)'.format(n=suppressed)
+        return True
+
+
+# Hands the records to the listener thread without formatting them.
+# The message is only formatted when it is written, so the arguments of a
+# log call must not change afterwards (pass bytes, not a memoryview).
+# When the queue is full the record is dropped instead of blocking the caller.
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+handler = None
+listener = None
+
+
+# sends all records of the root logger through a bounded queue to a background
+# thread that writes them to the given handlers (stderr by default)
+def setup(level=logging.INFO, rate: float = 10.0, burst: int = 20, maxsize: int = 10000, handlers=None):
+    global handler, listener
+    if handlers is None:
+        stream = logging.StreamHandler()
+        stream.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        handlers = [stream]
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize))
+    handler.addFilter(RateLimitFilter(rate, burst))
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(shutdown)
+
+
+# writes the queued records and stops the listener thread
+def shutdown():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
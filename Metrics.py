@@ -0,0 +1,143 @@
+import bisect
+import functools
+import threading
+import time
+
+# Instrumentation of the hot paths, exposed in the Prometheus text format.
+# Instrumented code checks Metrics.enabled first, so the overhead is a single
+# global lookup per frame when metrics are disabled.
+enabled = False
+
+registry = []
+
+# latency buckets in seconds, 10 us ... 1 s
+latency_buckets = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+
+def label_string(labelnames, labels, extra=''):
+    pairs = ['{name}="{value}"'.format(name=n, value=str(v).replace('\\', '\\\\').replace('"', '\\"'))
+             for n, v in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {name} {help}'.format(name=self.name, help=self.help),
+                 '# TYPE {name} counter'.format(name=self.name)]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('{name}{labels} {value}'.format(name=self.name,
+                                                             labels=label_string(self.labelnames, labels), value=value))
+        return lines
+
+
+# a value that is read when the metrics are rendered
+class Gauge:
+    def __init__(self, name: str, help: str, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def render(self):
+        return ['# HELP {name} {help}'.format(name=self.name, help=self.help),
+                '# TYPE {name} gauge'.format(name=self.name),
+                '{name} {value}'.format(name=self.name, value=self.function())]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(labels)
+            if v is None:
+                v = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                v[i] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    # observes the time since start, a time.monotonic_ns() value
+    def observe_since(self, start, *labels):
+        self.observe((time.monotonic_ns() - start) * 1e-9, *labels)
+
+    def render(self):
+        lines = ['# HELP {name} {help}'.format(name=self.name, help=self.help),
+                 '# TYPE {name} histogram'.format(name=self.name)]
+        with self.lock:
+            for labels, v in sorted(self.values.items()):
+                cumulative = 0
+                for le, n in zip(self.buckets, v):
+                    cumulative += n
+                    lines.append('{name}_bucket{labels} {n}'.format(
+                        name=self.name, labels=label_string(self.labelnames, labels, 'le="{le}"'.format(le=le)),
+                        n=cumulative))
+                lines.append('{name}_bucket{labels} {n}'.format(
+                    name=self.name, labels=label_string(self.labelnames, labels, 'le="+Inf"'), n=v[-1]))
+                lines.append('{name}_sum{labels} {s}'.format(name=self.name,
+                                                             labels=label_string(self.labelnames, labels), s=v[-2]))
+                lines.append('{name}_count{labels} {n}'.format(name=self.name,
+                                                               labels=label_string(self.labelnames, labels), n=v[-1]))
+        return lines
+
+
+def counter(name, help, labelnames=()):
+    metric = Counter(name, help, labelnames)
+    registry.append(metric)
+    return metric
+
+
+def gauge(name, help, function):
+    metric = Gauge(name, help, function)
+    registry.append(metric)
+    return metric
+
+
+def histogram(name, help, labelnames=(), buckets=latency_buckets):
+    metric = Histogram(name, help, labelnames, buckets)
+    registry.append(metric)
+    return metric
+
+
+# times every call of the decorated function while metrics are enabled
+def timed(metric, *labels):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.monotonic_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metric.observe_since(start, *labels)
+        return wrapper
+    return decorate
+
+
+# all metrics in the Prometheus text format
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
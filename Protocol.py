@@ -0,0 +1,414 @@
+import json
+import logging
+import math
+import os
+import time
+from array import array
+import RFLinkTools
+import Framer
+import Metrics
+from Device import DeviceType, DeviceInstance, FrameSignature
+
+log = logging.getLogger(__name__)
+
+decode_seconds = Metrics.histogram('rflink_decode_seconds', 'Time spent decoding received frames', ('protocol',))
+
+# descriptors of the device types that have no python module, see load_device_type
+directory = './protocols'
+
+# the mask of a symbol that has pulses with different masks, see Protocol.__classify
+mixed = 0xFF
+mixed_byte = bytes([mixed])
+# manchester halves: the other level, and the bit of a second half
+swap_levels = bytes.maketrans(b'lh', b'hl')
+level_bits = bytes.maketrans(b'lh', b'01')
+
+
+# Compiles a protocol descriptor into a decoder and encoder.
+# All pulse lengths are checked against integer bounds computed here. The
+# decoders match the symbols of a Framer.Frame with bytes operations, a
+# frame with a pulse in a symbol that straddles a bound is decoded pulse by
+# pulse, with a table lookup per pulse.
+#
+# A descriptor is a dict (or JSON object) with these keys, pulse lengths
+# are given in units of pulse_time, pulse_time in units of 10 us:
+#   name        name of the protocol
+#   encoding    'two_state': every bit is a pair of pulses, see symbols
+#               'manchester': every bit is a pulse_time High-Low (0) or Low-High (1)
+#   pulse_time  shortest pulse
+#   tolerance   allowed deviation of a received pulse, 0.25 is 25%
+#   header      pulses before the payload
+#   bits        number of payload bits
+#   footer      pulses after the payload
+#   symbols     two_state: {'0': [high, low], '1': [high, low]}
+# and the optional keys:
+#   header_tolerance  allowed deviation of the header pulses, default tolerance
+#   sync        [n, length]: the first n received pulses together last length
+#               pulse times, checked instead of the header pulses
+#   length      total length of a received frame in units of 10 us
+#   last_bit    manchester: the level before the first payload pulse
+#   static      manchester: constant leading payload bytes, encoded once
+#   control     the control values of a t: message, default [1, 1]
+#   fields      {name: [offset, nbits]}: payload bit fields, offset from the first bit
+class Protocol:
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+        self.name = descriptor['name']
+        self.encoding = descriptor['encoding']
+        self.pulse_time = int(descriptor['pulse_time'])
+        self.tolerance = float(descriptor.get('tolerance', 0.25))
+        self.header = [u * self.pulse_time for u in descriptor.get('header', [])]
+        self.footer = [u * self.pulse_time for u in descriptor.get('footer', [])]
+        self.bits = int(descriptor['bits'])
+        self.control = list(descriptor.get('control', [1, 1]))
+        self.fields = {name: (self.bits - offset - nbits, (1 << nbits) - 1)
+                       for name, (offset, nbits) in descriptor.get('fields', {}).items()}
+
+        # receive: the header or the sync pulses, then the payload
+        sync = descriptor.get('sync')
+        if sync is not None:
+            self.start = int(sync[0])
+            self.sync_bounds = self.bounds(sync[1] * self.pulse_time)
+            header_bounds = []
+        else:
+            self.start = len(self.header)
+            self.sync_bounds = None
+            header_tolerance = float(descriptor.get('header_tolerance', self.tolerance))
+            header_bounds = [self.bounds(p, header_tolerance) for p in self.header]
+        self.header_bounds = header_bounds
+
+        if self.encoding == 'two_state':
+            self.__compile_two_state(descriptor['symbols'])
+            min_pulses = max_pulses = self.start + 2 * self.bits + len(self.footer)
+        elif self.encoding == 'manchester':
+            self.__compile_manchester(descriptor)
+            # 1 or 2 bits per pulse, and a possible trailing pulse
+            min_pulses = self.start + self.bits
+            max_pulses = self.start + 2 * self.bits + 1
+        else:
+            raise Exception('unknown encoding ' + str(self.encoding))
+
+        length = descriptor.get('length')
+        self.length_bounds = self.bounds(length) if length is not None else None
+        min_length, max_length = self.length_bounds or (0, None)
+        self.signature = FrameSignature(min_pulses=min_pulses, max_pulses=max_pulses,
+                                        min_length=min_length, max_length=max_length, header=header_bounds)
+
+    # integer (min, max) of a received pulse length
+    def bounds(self, length, tolerance=None):
+        if tolerance is None:
+            tolerance = self.tolerance
+        return math.ceil(length * (1.0 - tolerance)), math.floor(length * (1.0 + tolerance))
+
+    # masks[pulse] has bit u set when the pulse matches units[u]
+    # symbol_masks[symbol] is the mask of all pulses of a Framer symbol, or
+    # mixed when they do not all have the same mask
+    def __classify(self, units):
+        bounds = [self.bounds(u * self.pulse_time) for u in units]
+        masks = bytearray(max(high for low, high in bounds) + 1)
+        for u, (low, high) in enumerate(bounds):
+            for p in range(low, high + 1):
+                masks[p] |= 1 << u
+        symbol_masks = bytearray(256)
+        for symbol, bounds in enumerate(Framer.symbol_bounds):
+            if bounds is None or bounds[0] >= len(masks):
+                continue
+            low, high = bounds
+            classes = set(masks[low:high + 1])
+            symbol_masks[symbol] = classes.pop() if len(classes) == 1 and high < len(masks) else mixed
+        self.symbol_masks = bytes(symbol_masks)
+        return bytes(masks)
+
+    def __compile_two_state(self, symbols):
+        units = sorted({u for b in symbols for u in symbols[b]})
+        self.masks = self.__classify(units)
+        # pairs[high mask << shift | low mask] is the bit the pair encodes,
+        # -1 when it matches no bit or more than one
+        self.shift = len(units)
+        self.pairs = [-1] * (1 << 2 * self.shift)
+        for high_mask in range(1 << self.shift):
+            for low_mask in range(1 << self.shift):
+                matches = [int(b) for b in symbols
+                           if high_mask & 1 << units.index(symbols[b][0]) and low_mask & 1 << units.index(symbols[b][1])]
+                if len(matches) == 1:
+                    self.pairs[high_mask << self.shift | low_mask] = matches[0]
+        # the pairs as a translation table to b'0', b'1' or b'x', when a pair fits in a byte
+        self.pair_bits = None
+        if 2 * self.shift <= 8:
+            self.pair_bits = bytes(b'x01'[bit + 1] for bit in self.pairs).ljust(256, b'x')
+        self.symbols = [[u * self.pulse_time for u in symbols['0']], [u * self.pulse_time for u in symbols['1']]]
+
+    def __compile_manchester(self, descriptor):
+        # the number of pulse times of a pulse (1 or 2), 0 if invalid
+        self.masks = masks = self.__classify([1, 2])
+        counts = [1 if m & 1 else 2 if m & 2 else 0 for m in masks]
+        # the halves of a pulse by mask and level: one (l, h) or two (L, H)
+        # pulse times, ! if invalid
+        self.halves = [bytes(b'!lL'[1 if m & 1 else 2 if m & 2 else 0] for m in range(256)),
+                       bytes(b'!hH'[1 if m & 1 else 2 if m & 2 else 0] for m in range(256))]
+        # the first pulse can be longer because of the header
+        self.first_min = self.bounds(self.pulse_time)[0]
+        self.last_bit = int(descriptor.get('last_bit', len(self.header) % 2))
+
+        # the decoder is a state machine, a state is the level of the next
+        # pulse s and the pending first half of a bit f (-1 if none): 3 * s + f + 1
+        # transitions[state][pulse] is the next state << 2, plus 2 and the bit
+        # when the pulse completes a bit, -1 if the pulse is invalid
+        self.transitions = []
+        for state in range(6):
+            s, first = divmod(state, 3)
+            results = [-1, self.__transition(s, first - 1, 1), self.__transition(s, first - 1, 2)]
+            self.transitions.append(array('b', [results[c] for c in counts]))
+        # the state after the first pulse, which is always a single half
+        self.initial = 3 * self.last_bit + (self.last_bit ^ 1) + 1
+        static = bytes(descriptor.get('static', []))
+        self.template = RFLinkTools.ManchesterTemplate(self.pulse_time, self.header, static, header=self.control)
+
+    @staticmethod
+    def __transition(s, first, count):
+        bit = -1
+        for _ in range(count):
+            if first < 0:
+                first = s
+            elif first == s:
+                return -1
+            else:
+                # Low-High is a 1, High-Low is a 0
+                bit = s
+                first = -1
+        state = 3 * (s ^ 1) + first + 1
+        return state << 2 | (2 | bit if bit >= 0 else 0)
+
+    # the payload of a received frame (a Framer.Frame or a sequence of pulses)
+    # as an integer, None if it does not match
+    def decode(self, pulses):
+        if not Metrics.enabled:
+            return self.__decode(pulses)
+        start = time.monotonic_ns()
+        try:
+            return self.__decode(pulses)
+        finally:
+            decode_seconds.observe_since(start, self.name)
+
+    def __decode(self, pulses):
+        frame = Framer.to_frame(pulses)
+        if self.length_bounds is not None:
+            low, high = self.length_bounds
+            if not low <= frame.length <= high:
+                return None
+        if self.sync_bounds is not None:
+            low, high = self.sync_bounds
+            if not low <= sum(frame[0:self.start]) <= high:
+                return None
+        else:
+            for pulse, (low, high) in zip(frame, self.header_bounds):
+                if not low <= pulse <= high:
+                    return None
+        if self.encoding == 'two_state':
+            return self.__decode_two_state(frame)
+        return self.__decode_manchester(frame)
+
+    def __decode_two_state(self, frame):
+        start = self.start
+        end = start + 2 * self.bits
+        if len(frame) != end + len(self.footer):
+            return None
+        if self.pair_bits is None:
+            return self.__decode_two_state_pulses(frame)
+        payload = frame.symbols[start:end].translate(self.symbol_masks)
+        if mixed_byte in payload:
+            return self.__decode_two_state_pulses(frame)
+        # the high and low masks of all bits at once, every byte a pair
+        pairs = int.from_bytes(payload[0::2], 'big') << self.shift | int.from_bytes(payload[1::2], 'big')
+        bits = pairs.to_bytes(self.bits, 'big').translate(self.pair_bits)
+        if b'x' in bits:
+            return None
+        return int(bits, 2)
+
+    def __decode_two_state_pulses(self, pulses):
+        end = self.start + 2 * self.bits
+        masks = self.masks
+        size = len(masks)
+        pairs = self.pairs
+        shift = self.shift
+        value = 0
+        for i in range(self.start, end, 2):
+            high = pulses[i]
+            low = pulses[i + 1]
+            bit = pairs[(masks[high] if high < size else 0) << shift | (masks[low] if low < size else 0)]
+            if bit < 0:
+                return None
+            value = value << 1 | bit
+        return value
+
+    # same as RFLinkTools.decode_manchester_int
+    # the first pulse is a single half of the other level than last_bit, the
+    # next pulses alternate starting at last_bit. The halves of all pulses
+    # are written out as l and h and taken in pairs, every pair is a bit.
+    def __decode_manchester(self, frame):
+        start = self.start
+        if len(frame) <= start or frame[start] < self.first_min:
+            return None
+        masks = frame.symbols[start + 1:].translate(self.symbol_masks)
+        if mixed_byte in masks:
+            return self.__decode_manchester_pulses(frame)
+        level = self.last_bit
+        pulses = bytearray(len(masks))
+        pulses[0::2] = masks[0::2].translate(self.halves[level])
+        pulses[1::2] = masks[1::2].translate(self.halves[level ^ 1])
+        if b'!' in pulses:
+            return None
+        halves = (b'l', b'h')[level ^ 1] + pulses.replace(b'L', b'll').replace(b'H', b'hh')
+        if len(halves) & 1:
+            # add a trailing low
+            halves += b'l'
+        first = halves[0::2]
+        second = halves[1::2]
+        if len(second) != self.bits or first.translate(swap_levels) != second:
+            return None
+        return int(second.translate(level_bits), 2)
+
+    def __decode_manchester_pulses(self, pulses):
+        if len(pulses) <= self.start or pulses[self.start] < self.first_min:
+            return None
+        transitions = self.transitions
+        size = len(transitions[0])
+        state = self.initial
+        value = 0
+        nbits = 0
+        for n in range(self.start + 1, len(pulses)):
+            pulse = pulses[n]
+            if pulse >= size:
+                return None
+            t = transitions[state][pulse]
+            if t < 0:
+                return None
+            state = t >> 2
+            if t & 2:
+                value = value << 1 | t & 1
+                nbits += 1
+        first = state % 3 - 1
+        if first >= 0:
+            # add a trailing low
+            if first == 0:
+                return None
+            value = value << 1
+            nbits += 1
+        if nbits != self.bits:
+            return None
+        return value
+
+    # {name: value} of the fields of a payload
+    def get_fields(self, value):
+        return {name: value >> shift & mask for name, (shift, mask) in self.fields.items()}
+
+    # the payload with the given field values
+    def set_fields(self, **fields):
+        value = 0
+        for name, v in fields.items():
+            shift, mask = self.fields[name]
+            value |= (int(v) & mask) << shift
+        return value
+
+    # encodes a payload into a TxFrame
+    def encode(self, value):
+        if self.encoding == 'manchester':
+            if self.bits % 8 == 0:
+                return self.template.encode_frame(RFLinkTools.int_to_bytes(value, self.bits))
+            pulses = self.control + RFLinkTools.encode_manchester_int(value, self.bits, self.pulse_time, self.header)
+            return RFLinkTools.TxFrame(pulses)
+        pulses = self.control + self.header
+        symbols = self.symbols
+        for i in range(self.bits - 1, -1, -1):
+            pulses += symbols[value >> i & 1]
+        return RFLinkTools.TxFrame(pulses + self.footer)
+
+    # manchester: encodes payload bytes, the leading bytes must be the static bytes
+    def encode_bytes(self, data):
+        return self.template.encode_frame(data)
+
+
+# a device instance of a descriptor-only device type, its id is the 'id' field
+class DescriptorInstance(DeviceInstance):
+    def __init__(self, device_type, id: int):
+        self.device_type = device_type
+        self.frames = {}  # command -> TxFrame, the frames only depend on the id
+        DeviceInstance.__init__(self, str(id), id)
+
+    def handle(self, timestamp, event, fields):
+        self.record(timestamp, event, fields.get('command', 0))
+
+    # the commands of the descriptor are methods of the instance
+    def __getattr__(self, command):
+        device_type = self.__dict__.get('device_type')
+        if device_type is None or command not in device_type.commands:
+            raise AttributeError(command)
+        return lambda: self.send(command)
+
+    def send(self, command):
+        frame = self.frames.get(command)
+        if frame is None:
+            protocol = self.device_type.protocol
+            fields = dict(self.device_type.command_fields[command])
+            if 'id' in protocol.fields:
+                fields['id'] = self.key
+            frame = self.frames[command] = protocol.encode(protocol.set_fields(**fields))
+        return frame
+
+
+# A device type defined by a descriptor only. Besides the protocol keys the
+# descriptor can have:
+#   commands    {name: {field: value}}: the commands and their field values,
+#               a received frame with these field values is a 'name' event
+#   tx          {'priority': .., 'repeats': .., 'gap': ..}
+#   dedup_window
+# Instances are created with an 'id' parameter, the value of the 'id' field.
+class DescriptorDeviceType(DeviceType):
+    def __init__(self, descriptor):
+        self.protocol = Protocol(descriptor)
+        self.signature = self.protocol.signature
+        tx = descriptor.get('tx', {})
+        self.tx_priority = tx.get('priority', DeviceType.tx_priority)
+        self.tx_repeats = tx.get('repeats', DeviceType.tx_repeats)
+        self.tx_gap = tx.get('gap', DeviceType.tx_gap)
+        self.dedup_window = descriptor.get('dedup_window', DeviceType.dedup_window)
+        self.command_fields = descriptor.get('commands', {})
+        # (field values, name) of the commands, most specific first
+        self.events = sorted(((tuple(f.items()), name) for name, f in self.command_fields.items()),
+                             key=lambda e: -len(e[0]))
+        DeviceType.__init__(self, self.protocol.name, list(self.command_fields))
+
+    def new_instance(self, parameters: {}):
+        instance = DescriptorInstance(self, int(parameters['id']))
+        self.add_instance(instance)
+        return instance
+
+    def to_key(self, instance_id):
+        return int(instance_id)
+
+    def parse(self, timestamp, pulses):
+        value = self.protocol.decode(pulses)
+        if value is None:
+            return False
+        if self.deduplicator.is_duplicate(value):
+            return True
+        fields = self.protocol.get_fields(value)
+        key = fields.get('id', value)
+        event = 'frame'
+        for values, name in self.events:
+            if all(fields.get(f) == v for f, v in values):
+                event = name
+                break
+        instance = self.lookup(key)
+        if instance is not None:
+            instance.handle(timestamp, event, fields)
+        else:
+            log.info('%s (unknown device): %s', self.type_name, fields or value)
+        self.publish(timestamp, key, event, known=instance is not None, **fields)
+        return True
+
+
+# creates the device type of the descriptor <directory>/<name>.json
+def load_device_type(name):
+    with open(os.path.join(directory, name + '.json')) as f:
+        return DescriptorDeviceType(json.load(f))
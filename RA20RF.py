@@ -7,35 +7,47 @@
 # header=8000,800
 # DeviceID = 48 pulses where: 0 = 800, 1600 and 1 = 800, 2800
 # footer=800,13000
-# message is repeated 3 times with 20ms delay
+# message is repeated 3 times with 20ms delay (by the firmware, control value 3)
 # Apparently there is no on or off instruction?
 #
-import RFLinkTools
 from Device import DeviceType, DeviceInstance
+from Protocol import Protocol
 import logging
 
+log = logging.getLogger(__name__)
+
 
 class RA20RFInstance(DeviceInstance):
     def __init__(self, device_id: int):
         self.device_id = [device_id >> 16 & 0xff, device_id >> 8 & 0xff, device_id >> 0 & 0xff]
-        DeviceInstance.__init__(self, str(device_id))
+        # the alarm frame only depends on the device id, it is encoded once
+        self.frame = None
+        DeviceInstance.__init__(self, str(device_id), device_id)
 
-    def handle(self):
-        logging.info("RA20RF: ALARM device id: {id}".format(id=self.device_id))
+    def handle(self, timestamp):
+        self.record(timestamp, 'alarm')
+        log.info('RA20RF: ALARM device id: %s', self.device_id)
 
     def alarm(self):
-        bits = RFLinkTools.bytes_to_bits(self.device_id)
-        pulses = [3, 1] + \
-                 [10 * RA20RFType.pulse_time, RA20RFType.pulse_time] + \
-                 RFLinkTools.encode_two_state(bits, RA20RFType.pulse_time, RA20RFType.bit_encoding) + \
-                 [RA20RFType.pulse_time, RA20RFType.pulse_time * 16]
-
-        return pulses
+        if self.frame is None:
+            self.frame = RA20RFType.protocol.encode(self.key)
+        return self.frame
 
 
 class RA20RFType(DeviceType):
-    pulse_time = 800
-    bit_encoding = {'0': [1, 2], '1': [1, 3]}
+    protocol = Protocol({'name': 'RA20RF',
+                         'encoding': 'two_state',
+                         'pulse_time': 800,
+                         'tolerance': 0.25,
+                         'header': [10, 1],
+                         'header_tolerance': 0.125,
+                         'bits': 24,
+                         'symbols': {'0': [1, 2], '1': [1, 3]},
+                         'footer': [1, 16],
+                         'control': [3, 1]})
+    signature = protocol.signature
+    # alarms go before anything else
+    tx_priority = 0
 
     def __init__(self):
         DeviceType.__init__(self, "RA20RF", ['alarm'])
@@ -44,21 +56,23 @@ class RA20RFType(DeviceType):
         device_id = int(parameters['device_id'])
         instance = RA20RFInstance(device_id)
         self.add_instance(instance)
+        return instance
+
+    def to_key(self, instance_id):
+        return int(instance_id)
 
     def parse(self, timestamp, pulses):
-        if len(pulses) == 52:
-            if (7000 <= pulses[0] <= 9000) and (700 <= pulses[1] <= 900):
-                bits = RFLinkTools.decode_two_state(pulses[2:50], self.pulse_time, self.bit_encoding, 0.25)
-                bytes_ = RFLinkTools.bits_to_bytes(bits)
-                device_id = bytes_[0] << 16 | bytes_[1] << 8 | bytes_[2]
+        device_id = self.protocol.decode(pulses)
+        if device_id is None:
+            return False
+        if self.deduplicator.is_duplicate(device_id):
+            return True
 
-                is_handled = False
-                for i in self.instances:
-                    if i.get_id() == str(device_id):
-                        i.handle()
-                        is_handled = True
-                if not is_handled:
-                    logging.info("RA20RF: device id:{id}".format(id=device_id))
-                return True
-        return False
+        instance = self.lookup(device_id)
+        if instance is not None:
+            instance.handle(timestamp)
+        else:
+            log.info('RA20RF: device id:%s', device_id)
+        self.publish(timestamp, device_id, 'alarm', known=instance is not None)
+        return True
 
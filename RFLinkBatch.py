@@ -0,0 +1,116 @@
+# Vectorized versions of the RFLinkTools decoders for offline analysis of
+# many frames at once (requires numpy).
+#
+# Frames are passed as a padded 2-D array of pulses plus the length of every
+# frame. The decoders return a padded 2-D array of bits (one bit per uint8),
+# the number of bits per frame and a validity mask. A frame is invalid where
+# the scalar decoder would raise an exception; its bits are all zero.
+# The results are identical to decode_manchester_int and decode_two_state_int.
+import numpy as np
+
+
+# converts a list of pulse lists into a padded 2-D array and the frame lengths
+def pad_frames(frames):
+    lengths = np.fromiter((len(f) for f in frames), dtype=np.int64, count=len(frames))
+    width = int(lengths.max()) if len(frames) > 0 else 0
+    pulses = np.zeros((len(frames), width), dtype=np.int64)
+    for i, f in enumerate(frames):
+        pulses[i, :len(f)] = f
+    return pulses, lengths
+
+
+# converts ragged frames (all pulses concatenated in values, frame i is
+# values[offsets[i]:offsets[i + 1]]) into a padded 2-D array and the frame lengths
+def from_ragged(offsets, values):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    lengths = np.diff(offsets)
+    width = int(lengths.max()) if len(lengths) > 0 else 0
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(rows)) - np.repeat(offsets[:-1] - offsets[0], lengths)
+    pulses = np.zeros((len(lengths), width), dtype=np.int64)
+    pulses[rows, cols] = values[offsets[0]:offsets[-1]]
+    return pulses, lengths
+
+
+# converts decoded bit arrays into integer bitfields, None for invalid frames
+def to_int(bits, nbits, valid):
+    result = []
+    for row, n, ok in zip(bits, nbits, valid):
+        if ok:
+            result.append(int(''.join('1' if b else '0' for b in row[:n]) or '0', 2))
+        else:
+            result.append(None)
+    return result
+
+
+# batched decode_manchester_int
+def decode_manchester(pulses, lengths, pulse_time: int, last_bit: int = 0):
+    pulses = np.asarray(pulses)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n, width = pulses.shape
+
+    # same boundaries as the scalar decoder, 15% tolerance
+    min_pulse_time = pulse_time * 0.85
+    max_pulse_time = pulse_time * 1.15
+
+    # bucket every pulse into 1 or 2 symbols, 0 for an invalid pulse length
+    inside = np.arange(width)[np.newaxis, :] < lengths[:, np.newaxis]
+    single = (min_pulse_time <= pulses) & (pulses <= max_pulse_time)
+    single[:, :1] |= pulses[:, :1] >= max_pulse_time
+    double = ~single & (2 * min_pulse_time <= pulses) & (pulses <= 2 * max_pulse_time)
+    counts = np.where(single, 1, np.where(double, 2, 0))
+    valid = ~np.any(inside & (counts == 0), axis=1)
+    counts = np.where(inside & valid[:, np.newaxis], counts, 0)
+
+    # pulse j is a run of symbol (last_bit ^ 1) ^ (j & 1), lay the symbols out
+    # per frame, padded with lows (this adds the trailing low of an odd frame)
+    levels = ((last_bit ^ 1) ^ (np.arange(width) & 1)).astype(np.uint8)
+    total = counts.sum(axis=1)
+    npairs = (total + 1) // 2
+    symbols = np.zeros((n, 2 * int(npairs.max()) if n > 0 else 0), dtype=np.uint8)
+    flat_counts = counts.ravel()
+    rows = np.repeat(np.repeat(np.arange(n), width), flat_counts)
+    starts = np.repeat(np.cumsum(total) - total, total)
+    cols = np.arange(len(rows)) - starts
+    symbols[rows, cols] = np.repeat(np.tile(levels, n), flat_counts)
+
+    # Low-High is a 1, High-Low is a 0, anything else is invalid
+    first = symbols[:, 0::2]
+    second = symbols[:, 1::2]
+    in_pair = np.arange(first.shape[1])[np.newaxis, :] < npairs[:, np.newaxis]
+    valid &= ~np.any(in_pair & (first == second), axis=1)
+
+    bits = np.where(in_pair & valid[:, np.newaxis], second, 0).astype(np.uint8)
+    nbits = np.where(valid, npairs, 0)
+    return bits, nbits, valid
+
+
+# batched decode_two_state_int
+def decode_two_state(pulses, lengths, pulse_time, bit_encoding, tolerance):
+    pulses = np.asarray(pulses)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n, width = pulses.shape
+    if width % 2 > 0:
+        pulses = np.pad(pulses, ((0, 0), (0, 1)))
+    high = pulses[:, 0::2]
+    low = pulses[:, 1::2]
+
+    npairs = lengths // 2
+    in_pair = np.arange(high.shape[1])[np.newaxis, :] < npairs[:, np.newaxis]
+
+    # every pair must match the encoding of exactly one bit
+    matches = np.zeros(high.shape, dtype=np.int64)
+    bits = np.zeros(high.shape, dtype=np.uint8)
+    for b in bit_encoding:
+        match = (bit_encoding[b][0] * pulse_time * (1.0 - tolerance) <= high) & \
+                (high <= bit_encoding[b][0] * pulse_time * (1.0 + tolerance)) & \
+                (bit_encoding[b][1] * pulse_time * (1.0 - tolerance) <= low) & \
+                (low <= bit_encoding[b][1] * pulse_time * (1.0 + tolerance))
+        matches += match
+        bits[match] = int(b)
+
+    valid = (lengths % 2 == 0) & ~np.any(in_pair & (matches != 1), axis=1)
+    bits = np.where(in_pair & valid[:, np.newaxis], bits, 0).astype(np.uint8)
+    nbits = np.where(valid, npairs, 0)
+    return bits, nbits, valid
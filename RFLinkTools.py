@@ -1,20 +1,35 @@
-from math import ceil
+import struct
 
 
 def length(pulses):
     return sum(pulses)
 
 
+# converts a byte array into an integer bitfield and its bit count
+# [0xA7, 0x01] -> (0xA701, 16)
+def bytes_to_int(bytes_):
+    return int.from_bytes(bytes(bytes_), 'big'), 8 * len(bytes_)
+
+
+# converts an integer bitfield into a byte array (most significant bit first)
+# a trailing partial byte holds the remaining bits right-aligned, like int(bits, 2)
+def int_to_bytes(value, nbits):
+    full, rest = divmod(nbits, 8)
+    bytes_ = bytearray((value >> rest).to_bytes(full, 'big'))
+    if rest:
+        bytes_.append(value & ((1 << rest) - 1))
+    return bytes_
+
+
 # converts a byte array into a bit string
 def bytes_to_bits(bytes_):
-    return ''.join(format(byte, '08b') for byte in bytes_)
+    value, nbits = bytes_to_int(bytes_)
+    return format(value, '0{n}b'.format(n=nbits)) if nbits else ''
 
 
 # converts a bit string into a byte array
 def bits_to_bytes(bits):
-    bytes_ = [bits[8 * i:8 * (i + 1)] for i in range(ceil(len(bits) / 8))]
-    bytes_ = [int(i, 2) for i in bytes_]
-    return bytes_
+    return list(int_to_bytes(int(bits, 2) if bits else 0, len(bits)))
 
 
 # converts pulse string into an integer array
@@ -31,23 +46,20 @@ def pulses_to_string(pulses):
 # needed for the encoding context
 # For example: "1010" becomes [100,200,200,200,100] (pulse time = 100)
 def encode_manchester(bits, pulse_time: int, preamble):
-    # convert the bit-string to symbols
+    return encode_manchester_int(int(bits, 2) if bits else 0, len(bits), pulse_time, preamble)
+
 
+# same as encode_manchester, but the bits are an integer bitfield of nbits
+def encode_manchester_int(value, nbits, pulse_time: int, preamble):
     if len(preamble) == 0:
         raise Exception("preamble is required for encoding")
-    else:
-        if len(preamble) % 2 == 0:
-            # even number of pulses so the last pulse must be a LOW
-            last_bit = "0"
-        else:
-            # odd number of pulses so the last pulse must be a HIGH
-            last_bit = "1"
-        s = 0
 
-    pulses = preamble.copy()
+    # an even number of pulses ends with a LOW, an odd number with a HIGH
+    last_bit = len(preamble) % 2
 
-    for i in range(s, len(bits)):
-        b = bits[i]
+    pulses = list(preamble)
+    for i in range(nbits - 1, -1, -1):
+        b = (value >> i) & 1
         if b != last_bit:
             pulses[-1] += pulse_time
             pulses.append(pulse_time)
@@ -63,70 +75,226 @@ def encode_manchester(bits, pulse_time: int, preamble):
 # the pulses, an integer array, should be stripped from preamble.
 # For example: [100,200,200,200,100] becomes "1010" (pulse time = 100)
 def decode_manchester(pulses, pulse_time: int, last_bit: int = 0):
-    symbols = ""  # '1' is High, '0' is Low
+    value, nbits = decode_manchester_int(pulses, pulse_time, last_bit)
+    return format(value, '0{n}b'.format(n=nbits)) if nbits else ''
+
 
+# same as decode_manchester, but returns an integer bitfield and its bit count
+def decode_manchester_int(pulses, pulse_time: int, last_bit: int = 0):
     # pulse length boundaries, 15% tolerance
     min_pulse_time = pulse_time * 0.85
     max_pulse_time = pulse_time * 1.15
+    min_double_time = 2 * min_pulse_time
+    max_double_time = 2 * max_pulse_time
 
     # each bit is encoded either High-Low(0) or Low-High(1)
     # But the first pulse can be longer than 1 * pulse time
     # because of a preamble
-    if pulses[0] >= max_pulse_time:
-        pulses[0] = pulse_time
-
-    s = last_bit ^ 1
-    for pulse in pulses:
-        if min_pulse_time <= pulse <= max_pulse_time:
-            symbols += str(s)
-            s = s ^ 1
-        elif 2 * min_pulse_time <= pulse <= 2 * max_pulse_time:
-            symbols += str(s)
-            symbols += str(s)
-            s = s ^ 1
+    s = last_bit ^ 1  # 1 is High, 0 is Low
+    first = -1  # first half of the current symbol pair, -1 if none
+    value = 0
+    nbits = 0
+    for n, pulse in enumerate(pulses):
+        if min_pulse_time <= pulse <= max_pulse_time or (n == 0 and pulse >= max_pulse_time):
+            count = 1
+        elif min_double_time <= pulse <= max_double_time:
+            count = 2
         else:
             raise Exception("Invalid pulse length")
 
-    if len(symbols) % 2 != 0:
+        for _ in range(count):
+            if first < 0:
+                first = s
+            elif first == s:
+                raise Exception("Invalid encoding")
+            else:
+                # Low-High is a 1, High-Low is a 0
+                value = (value << 1) | s
+                nbits += 1
+                first = -1
+        s = s ^ 1
+
+    if first >= 0:
         # add a trailing low
-        symbols += "0"
-
-    bits = ""
-    for i in range(0, len(symbols), 2):
-        symbol = symbols[i:int(i + 2)]
-        if symbol == "01":
-            bits += "1"
-        elif symbol == "10":
-            bits += "0"
-        else:
+        if first == 0:
             raise Exception("Invalid encoding")
+        value = value << 1
+        nbits += 1
 
-    return bits
+    return value, nbits
 
 
 def encode_two_state(bits, pulse_time, bit_encoding):
+    return encode_two_state_int(int(bits, 2) if bits else 0, len(bits), pulse_time, bit_encoding)
+
+
+# same as encode_two_state, but the bits are an integer bitfield of nbits
+def encode_two_state_int(value, nbits, pulse_time, bit_encoding):
+    symbols = [[p * pulse_time for p in bit_encoding['0']],
+               [p * pulse_time for p in bit_encoding['1']]]
     pulses = []
-    for b in bits:
-        p = bit_encoding[b]
-        pulses.append(p[0]*pulse_time)
-        pulses.append(p[1]*pulse_time)
+    for i in range(nbits - 1, -1, -1):
+        pulses += symbols[(value >> i) & 1]
     return pulses
 
 
 def decode_two_state(pulses, pulse_time, bit_encoding, tolerance):
-    bits = ''
+    value, nbits = decode_two_state_int(pulses, pulse_time, bit_encoding, tolerance)
+    return format(value, '0{n}b'.format(n=nbits)) if nbits else ''
+
+
+# same as decode_two_state, but returns an integer bitfield and its bit count
+# every bit is a pair of pulses; both must match the encoding of exactly one bit
+def decode_two_state_int(pulses, pulse_time, bit_encoding, tolerance):
     if len(pulses) % 2 > 0:
         raise Exception("Invalid encoding")
 
+    bounds = [(int(b),
+               bit_encoding[b][0] * pulse_time * (1.0 - tolerance), bit_encoding[b][0] * pulse_time * (1.0 + tolerance),
+               bit_encoding[b][1] * pulse_time * (1.0 - tolerance), bit_encoding[b][1] * pulse_time * (1.0 + tolerance))
+              for b in bit_encoding]
+
+    value = 0
     for p in range(0, len(pulses), 2):
-        for b in bit_encoding:
-            if (bit_encoding[b][0] * pulse_time * (1.0-tolerance)) <= pulses[p] <=\
-                    (bit_encoding[b][1] * pulse_time * (1.0 + tolerance)):
-                if (bit_encoding[b][0] * pulse_time * (1.0 - tolerance)) <= pulses[p] \
-                        <= (bit_encoding[b][1] * pulse_time * (1.0 + tolerance)):
-                    bits += b
-
-    if len(bits) != len(pulses) / 2:
-        raise Exception("Invalid encoding")
-    return bits
+        high = pulses[p]
+        low = pulses[p + 1]
+        bit = -1
+        for b, min_high, max_high, min_low, max_low in bounds:
+            if min_high <= high <= max_high and min_low <= low <= max_low:
+                if bit >= 0:
+                    raise Exception("Invalid encoding")
+                bit = b
+        if bit < 0:
+            raise Exception("Invalid encoding")
+        value = (value << 1) | bit
+
+    return value, len(pulses) // 2
+
+
+# precompiled manchester encoder for frames that start with constant bytes
+# the header, preamble and static bytes are encoded once, the remaining bytes
+# of a frame are encoded with a table of pulses per (last bit, byte)
+class ManchesterTemplate:
+    def __init__(self, pulse_time: int, preamble, static=b'', header=()):
+        value, nbits = bytes_to_int(static)
+        self.pulse_time = pulse_time
+        self.prefix = list(header) + encode_manchester_int(value, nbits, pulse_time, preamble)
+        self.offset = len(static)
+        self.last_bit = value & 1 if nbits > 0 else len(preamble) % 2
+
+        # the first pulse of a byte can extend the last pulse of the previous one
+        self.table = []
+        for last_bit in (0, 1):
+            context = [0] * (2 - last_bit)
+            entries = []
+            for byte in range(256):
+                pulses = encode_manchester_int(byte, 8, pulse_time, context)
+                entries.append((pulses[len(context) - 1], tuple(pulses[len(context):])))
+            self.table.append(entries)
+
+        # the t: message, every byte ends with a single pulse time that can still
+        # be extended by the next byte, so that pulse is written with the next byte
+        self.prefix_text = ('t:' + ''.join(str(p) + ',' for p in self.prefix[:-1])).encode('utf-8')
+        self.text = [[(str(pulse_time + extend) + ',' + ''.join(str(p) + ',' for p in tail[:-1])).encode('utf-8')
+                      for extend, tail in entries] for entries in self.table]
+
+    # encodes a frame, data[:offset] must be the static bytes of the template
+    def encode(self, data):
+        pulses = self.prefix.copy()
+        table = self.table
+        last_bit = self.last_bit
+        for i in range(self.offset, len(data)):
+            byte = data[i]
+            extend, tail = table[last_bit][byte]
+            pulses[-1] += extend
+            pulses += tail
+            last_bit = byte & 1
+        return pulses
+
+    # encodes a frame into a TxFrame including its t: message
+    def encode_frame(self, data):
+        parts = [self.prefix_text]
+        pending = self.prefix[-1]
+        last_bit = self.last_bit
+        for i in range(self.offset, len(data)):
+            byte = data[i]
+            if pending == self.pulse_time:
+                parts.append(self.text[last_bit][byte])
+            else:
+                extend, tail = self.table[last_bit][byte]
+                parts.append((str(pending + extend) + ',' + ''.join(str(p) + ',' for p in tail[:-1])).encode('utf-8'))
+                pending = self.pulse_time
+            last_bit = byte & 1
+        parts.append(str(pending).encode('utf-8') + b'\n')
+        return TxFrame(self.encode(data), b''.join(parts))
+
+
+# The compact binary form of a t: message, for firmware that supports it:
+#   'T', uint8 number of widths, the uint16 widths, the 2 uint16 control
+#   values, uint16 number of pulses, and the index of the width of every
+#   pulse, two per byte, high nibble first
+# little endian. A frame has at most 16 different pulse widths.
+binary_marker = b'T'
+binary_header = struct.Struct('<cB')
+binary_counts = struct.Struct('<HHH')
+
+
+# the binary message of pulses (control values first), None if it cannot be encoded
+def encode_binary(pulses):
+    body = pulses[2:]
+    widths = sorted(set(body))
+    if len(widths) > 16 or (widths and widths[-1] > 0xFFFF) or not 0 <= min(pulses[0:2]) <= max(pulses[0:2]) <= 0xFFFF:
+        return None
+    index = {width: i for i, width in enumerate(widths)}
+    indices = bytes(map(index.__getitem__, body))
+    if len(indices) & 1:
+        indices += b'\0'
+    n = len(indices) // 2
+    packed = (int.from_bytes(indices[0::2], 'big') << 4 | int.from_bytes(indices[1::2], 'big')).to_bytes(n, 'big')
+    return (binary_header.pack(binary_marker, len(widths)) + struct.pack('<{n}H'.format(n=len(widths)), *widths)
+            + binary_counts.pack(pulses[0], pulses[1], len(body)) + packed)
+
+
+# decodes a binary message at the start of data
+# returns (pulses, message length), None if data does not hold a complete message
+def decode_binary(data):
+    if len(data) < binary_header.size or data[0:1] != binary_marker:
+        return None
+    nwidths = data[1]
+    offset = binary_header.size + 2 * nwidths
+    if len(data) < offset + binary_counts.size:
+        return None
+    widths = struct.unpack_from('<{n}H'.format(n=nwidths), data, binary_header.size)
+    control1, control2, count = binary_counts.unpack_from(data, offset)
+    offset += binary_counts.size
+    end = offset + (count + 1) // 2
+    if len(data) < end:
+        return None
+    pulses = [control1, control2]
+    for byte in data[offset:end]:
+        pulses += (widths[byte >> 4], widths[byte & 15])
+    return pulses[:2 + count], end
+
+
+# a frame to transmit, the t: message and its binary form are encoded only once
+class TxFrame:
+    __slots__ = ('pulses', 'airtime', 'data', 'binary')
+
+    def __init__(self, pulses, data=None):
+        self.pulses = pulses
+        # the first two values are control values, the pulses are in units of 10 us
+        # the firmware sends the frame as often as the first control value
+        self.airtime = sum(pulses[2:]) * 1e-5 * max(1, pulses[0])
+        self.data = data
+        self.binary = None
 
+    # the t: message, or with binary the binary message if the frame can be encoded
+    def encode(self, binary=False):
+        if binary:
+            if self.binary is None:
+                self.binary = encode_binary(self.pulses) or b''
+            if self.binary:
+                return self.binary
+        if self.data is None:
+            self.data = ('t:' + pulses_to_string(self.pulses) + '\n').encode('utf-8')
+        return self.data
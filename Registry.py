@@ -0,0 +1,95 @@
+import json
+import logging
+import sqlite3
+import threading
+
+
+# Persistent administration of the device types and device instances.
+# SQLite in WAL mode: every added type or instance is a single row insert,
+# and everything is loaded with one query per table at startup.
+class Registry:
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS device_type ('
+                                'position INTEGER NOT NULL, '
+                                'device_module TEXT NOT NULL, '
+                                'device_type TEXT PRIMARY KEY)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS device_instance ('
+                                'device_type TEXT NOT NULL, '
+                                'instance_id TEXT NOT NULL, '
+                                'parameters TEXT NOT NULL, '
+                                'PRIMARY KEY (device_type, instance_id))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS device_group ('
+                                'name TEXT NOT NULL, '
+                                'device_type TEXT NOT NULL, '
+                                'instance_id TEXT NOT NULL, '
+                                'PRIMARY KEY (name, device_type, instance_id))')
+
+    def is_empty(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM device_type').fetchone()[0] == 0
+
+    # returns [(device_module, device_type)] and [(type_name, instance_id, parameters)]
+    def load(self):
+        with self.lock:
+            types = self.connection.execute(
+                'SELECT device_module, device_type FROM device_type ORDER BY position').fetchall()
+            instances = [(type_name, instance_id, json.loads(parameters)) for type_name, instance_id, parameters in
+                         self.connection.execute(
+                             'SELECT device_type, instance_id, parameters FROM device_instance ORDER BY rowid')]
+        return types, instances
+
+    def add_device_type(self, device_module: str, device_type: str, position: int):
+        with self.lock:
+            self.connection.execute('INSERT INTO device_type (position, device_module, device_type) VALUES (?, ?, ?)',
+                                    (position, device_module, device_type))
+
+    def add_instance(self, type_name: str, instance_id: str, parameters: {}):
+        with self.lock:
+            self.connection.execute('INSERT INTO device_instance (device_type, instance_id, parameters) '
+                                    'VALUES (?, ?, ?)', (type_name, instance_id, json.dumps(parameters)))
+
+    # returns {name: [(type_name, instance_id)]}
+    def load_groups(self):
+        groups = {}
+        with self.lock:
+            for name, type_name, instance_id in self.connection.execute(
+                    'SELECT name, device_type, instance_id FROM device_group ORDER BY rowid'):
+                groups.setdefault(name, []).append((type_name, instance_id))
+        return groups
+
+    def add_group_members(self, name: str, members):
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.executemany('INSERT OR IGNORE INTO device_group (name, device_type, instance_id) '
+                                            'VALUES (?, ?, ?)', [(name, t, i) for t, i in members])
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    # imports the device types of the TinyDB database used by earlier versions
+    def import_tinydb(self, filename: str):
+        try:
+            from tinydb import TinyDB
+        except ImportError:
+            logging.warning('tinydb is not installed, {file} is not imported'.format(file=filename))
+            return
+
+        db = TinyDB(filename)
+        try:
+            for dt in db.table('device_type').all():
+                self.add_device_type(dt['device_module'], dt['device_type'], int(dt['id']))
+                logging.info('Imported device type {module}.{type} from {file}'.format(
+                    module=dt['device_module'], type=dt['device_type'], file=filename))
+        finally:
+            db.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,136 @@
+import logging
+import os
+import struct
+import threading
+
+
+# Keeps the rolling codes of remotes over restarts.
+#
+# The store keeps a reservation per remote: a code that is at least the last
+# code sent. A sent code that passes the reservation reserves sync_every codes
+# ahead, the new reservation is appended to a journal of small fixed size
+# records and fsync'ed before the code is sent. After a crash a remote
+# continues after its reservation, so a code that was already sent is never
+# sent again, and restarts without sending do not move the codes. A clean
+# close stores the exact codes, nothing is skipped then.
+# Received codes (update with sync=False) are appended to the journal but
+# only fsync'ed by a background thread every sync_interval seconds, so the
+# serial reader never waits for the disk; losing one only means the next code
+# sent is lower than the remote's. The journal is compacted into a snapshot
+# after compact_after records.
+class RollingCodeStore:
+    record = struct.Struct('<II')  # remote, reservation
+
+    def __init__(self, filename: str, sync_every: int = 16, sync_interval: float = 1.0, compact_after: int = 4096):
+        self.filename = filename
+        self.journal_filename = filename + '.journal'
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+
+        self.reserved = {}
+        self.__load(self.filename)
+        self.__load(self.journal_filename)
+        # continue after the reservations, the codes sent before are at most these
+        self.codes = dict(self.reserved)
+
+        self.journal = None
+        self.__compact()
+        self.dirty = False  # records since the last sync
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, name='RollingCodeStore', daemon=True)
+        self.thread.start()
+        logging.info('Loaded {n} rolling codes from {file}'.format(n=len(self.codes), file=filename))
+
+    def __load(self, filename):
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # a partially written last record is ignored, reservations never go back
+        # (a journal left behind by an interrupted compaction is older than the snapshot)
+        end = len(data) - len(data) % self.record.size
+        for remote, code in self.record.iter_unpack(data[:end]):
+            self.reserved[remote] = max(code, self.reserved.get(remote, code))
+
+    # writes all reservations to a new snapshot and starts an empty journal
+    def __compact(self):
+        if self.journal is not None:
+            self.journal.close()
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(b''.join(self.record.pack(remote, code) for remote, code in self.reserved.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        self.__sync_directory()
+        self.journal = open(self.journal_filename, 'wb', buffering=0)
+        self.journal_records = 0
+        self.dirty = False
+
+    def __sync_directory(self):
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def get(self, remote: int, default=None):
+        return self.codes.get(remote, default)
+
+    # sync is False for a received code, its record is left to the background thread
+    # a sent code returns when its reservation is on disk
+    def update(self, remote: int, code: int, sync: bool = True):
+        with self.lock:
+            if self.journal is None:
+                raise Exception('rolling code store is closed')
+            self.codes[remote] = code
+            if code <= self.reserved.get(remote, -1):
+                return
+            self.reserved[remote] = code + self.sync_every if sync else code
+            self.journal.write(self.record.pack(remote, self.reserved[remote]))
+            self.journal_records += 1
+            self.dirty = True
+            if not sync:
+                return
+            if self.journal_records >= self.compact_after:
+                self.__compact()
+            else:
+                self.__sync()
+
+    def __sync(self):
+        os.fsync(self.journal.fileno())
+        self.dirty = False
+
+    # syncs, or compacts, the journal every sync_interval seconds
+    def __run(self):
+        while not self.stopped.wait(self.sync_interval):
+            with self.lock:
+                if self.journal is None:
+                    break
+                if self.journal_records >= self.compact_after:
+                    self.__compact()
+                elif self.dirty:
+                    self.__sync()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.__sync()
+
+    # stores the exact codes, a restart continues with them
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            if self.journal is not None:
+                self.reserved.update(self.codes)
+                self.__compact()
+                self.journal.close()
+                self.journal = None
@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import Metrics
+
+wait_seconds = Metrics.histogram('rflink_transmit_wait_seconds', 'Time commands waited in the transmit queue')
+command_seconds = Metrics.histogram('rflink_command_seconds', 'Time from executing a command until it was written')
+
+
+class TransmitJob:
+    __slots__ = ('priority', 'seq', 'key', 'frame', 'repeats', 'gap', 'airtime', 'queued', 'started', 'future')
+
+    def __init__(self, priority, seq, key, frame, repeats, gap, started=None):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.frame = frame
+        self.repeats = repeats
+        self.gap = gap
+        self.airtime = frame.airtime * repeats
+        self.queued = time.monotonic()
+        # time.monotonic_ns() when the command was started
+        self.started = time.monotonic_ns() if started is None else started
+        self.future = Future()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+# Queues commands between the device types and the serial port.
+# The most urgent job (lowest priority value) is sent first, jobs of equal
+# priority in order of arrival. A job is sent repeats times with gap seconds
+# in between. The total airtime within airtime_window seconds is limited to
+# airtime_budget seconds (10% duty cycle by default).
+# A key is a tuple that identifies the device followed by the command. A job is
+# coalesced with the most recent queued job of the same device when that job
+# has the same command, so "up, up" is sent once but "up, down, up" in full.
+class TransmitScheduler:
+    def __init__(self, transmit, airtime_budget: float = 360.0, airtime_window: float = 3600.0):
+        self.transmit = transmit
+        self.airtime_budget = airtime_budget
+        self.airtime_window = airtime_window
+
+        self.queue = []
+        self.pending = {}  # device -> most recent queued job
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.history = deque()  # (time, airtime) of the sent jobs within the window
+        self.airtime_used = 0.0
+
+        # statistics
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, name='TransmitScheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    # coalesces a job with this key before it is encoded, returns the future of
+    # the queued job or None. A coalesced command then does not use e.g. a
+    # rolling code that is never sent.
+    def coalesce(self, key):
+        with self.condition:
+            job = self.__coalesce(key)
+            if job is None:
+                return None
+            self.coalesced += 1
+            return job.future
+
+    def __coalesce(self, key):
+        if key is None:
+            return None
+        job = self.pending.get(key[:-1])
+        if job is not None and job.key == key:
+            return job
+        return None
+
+    def __push(self, frame, priority, repeats, gap, key, started):
+        job = self.__coalesce(key)
+        if job is not None:
+            self.coalesced += 1
+            return job.future
+        job = TransmitJob(priority, next(self.sequence), key, frame, repeats, gap, started)
+        heapq.heappush(self.queue, job)
+        if key is not None:
+            self.pending[key[:-1]] = job
+        return job.future
+
+    # queues a TxFrame for transmission, returns a future that completes when it is sent
+    def submit(self, frame, priority: int = 10, repeats: int = 1, gap: float = 0.0, key=None, started=None):
+        with self.condition:
+            future = self.__push(frame, priority, repeats, gap, key, started)
+            self.condition.notify()
+            return future
+
+    # queues (frame, repeats, gap, key) jobs that are sent in this order, unless
+    # a more urgent job comes in between, returns a future per job
+    def submit_batch(self, jobs, priority: int = 10, started=None):
+        with self.condition:
+            futures = [self.__push(frame, priority, repeats, gap, key, started) for frame, repeats, gap, key in jobs]
+            self.condition.notify()
+        return futures
+
+    # True while a job of this device, a key without the command, is queued
+    def is_pending(self, device):
+        return device in self.pending
+
+    def depth(self):
+        return len(self.queue)
+
+    def stats(self):
+        with self.condition:
+            return {'depth': len(self.queue),
+                    'sent': self.sent,
+                    'coalesced': self.coalesced,
+                    'failed': self.failed,
+                    'wait_avg': self.wait_total / self.sent if self.sent > 0 else 0.0,
+                    'wait_max': self.wait_max,
+                    'airtime_used': self.airtime_used,
+                    'airtime_budget': self.airtime_budget}
+
+    # seconds until the airtime of a job fits in the budget
+    def __budget_delay(self, now, job_airtime):
+        while self.history and self.history[0][0] <= now - self.airtime_window:
+            self.airtime_used -= self.history.popleft()[1]
+        excess = self.airtime_used + job_airtime - self.airtime_budget
+        if excess <= 0 or not self.history:
+            return 0.0
+        for t, a in self.history:
+            excess -= a
+            if excess <= 0:
+                return t + self.airtime_window - now
+        return self.airtime_window
+
+    def __next_job(self):
+        with self.condition:
+            while self.running:
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                now = time.monotonic()
+                delay = self.__budget_delay(now, self.queue[0].airtime)
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                job = heapq.heappop(self.queue)
+                if job.key is not None and self.pending.get(job.key[:-1]) is job:
+                    del self.pending[job.key[:-1]]
+                self.history.append((now, job.airtime))
+                self.airtime_used += job.airtime
+                wait = now - job.queued
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.sent += 1
+                if Metrics.enabled:
+                    wait_seconds.observe(wait)
+                return job
+            return None
+
+    def __run(self):
+        while True:
+            job = self.__next_job()
+            if job is None:
+                break
+            try:
+                for i in range(job.repeats):
+                    if i > 0:
+                        time.sleep(job.gap)
+                    self.transmit(job.frame)
+                    if i == 0 and Metrics.enabled:
+                        command_seconds.observe_since(job.started)
+                job.future.set_result(True)
+            except Exception as e:
+                logging.error('Transmit failed: ' + str(e))
+                with self.condition:
+                    self.failed += 1
+                job.future.set_exception(e)
@@ -29,10 +29,14 @@
 
 # The remote buttons
 import RFLinkTools
+from RollingCodeStore import RollingCodeStore
 from enum import Enum
 from Device import DeviceType, DeviceInstance
+from Protocol import Protocol
 import logging
 
+log = logging.getLogger(__name__)
+
 
 class BlindButtons(Enum):
     none = 0x00
@@ -43,39 +47,28 @@ class BlindButtons(Enum):
 
 
 class SomfyRemoteInstance(DeviceInstance):
-    def __init__(self, code, remote):
+    def __init__(self, code, remote, code_store=None):
         self.code = code
         self.remote = remote
+        self.code_store = code_store
         self.last_button = BlindButtons.none
-        DeviceInstance.__init__(self, str(remote))
-
-    def __preamble(self):
-        preamble = []
-
-        # hardware sync
-        for i in range(0, 4):
-            preamble.append(4 * SomfyRemoteType.pulse_time)
-
-        # soft sync
-        preamble.append(7 * SomfyRemoteType.pulse_time)
-        preamble.append(1 * SomfyRemoteType.pulse_time)
-
-        return preamble
+        DeviceInstance.__init__(self, str(remote), remote)
 
     def __get_pulses(self, button: BlindButtons):
         self.code += 1
+        if self.code_store is not None:
+            self.code_store.update(self.remote, self.code)
         cmd = RtsCommand()
         cmd.encode(button, self.code, self.remote)
-        bits = RFLinkTools.bytes_to_bits(cmd.data)
-        pulses = RFLinkTools.encode_manchester(bits, 64, self.__preamble())
-        return [1, 1] + pulses
+        return SomfyRemoteType.protocol.encode_bytes(cmd.data)
 
-    def handle(self, cmd):
+    def handle(self, timestamp, cmd):
         self.code = cmd.code
+        if self.code_store is not None:
+            self.code_store.update(self.remote, self.code, sync=False)
         self.last_button = BlindButtons(cmd.button)
-        logging.info("Somfy RTS: remote:{remote} code:{code} button:{button}".format(remote=cmd.remote,
-                                                                                     code=cmd.code,
-                                                                                     button=cmd.button))
+        self.record(timestamp, self.last_button.name, cmd.button, code=cmd.code)
+        log.info('Somfy RTS: remote:%s code:%s button:%s', cmd.remote, cmd.code, cmd.button)
 
     def stop(self):
         return self.__get_pulses(BlindButtons.stop)
@@ -91,44 +84,69 @@ class SomfyRemoteInstance(DeviceInstance):
 
 
 class SomfyRemoteType(DeviceType):
-    pulse_time = 64  # 64 * 10us = 640 us
-
-    def __init__(self):
+    # 64 * 10us = 640 us per half bit, hardware sync + soft sync, 56 manchester encoded bits
+    # received are the 5 sync pulses, the soft sync pulse merges with the first data pulse
+    # the control values, preamble and the key byte (always 0xA7) are encoded once
+    protocol = Protocol({'name': 'SomfyRTS',
+                         'encoding': 'manchester',
+                         'pulse_time': 64,
+                         'tolerance': 0.15,
+                         'header': [4, 4, 4, 4, 7, 1],
+                         'sync': [5, 24],
+                         'bits': 56,
+                         'length': 8704,
+                         'last_bit': 1,
+                         'static': [0xA7]})
+    signature = protocol.signature
+
+    # a held button repeats the same frame
+    dedup_window = 1.0
+    # keeps the rolling codes over restarts
+    code_store_filename = './somfy_rts.codes'
+
+    def __init__(self, code_store=None):
         DeviceType.__init__(self, "SomfyRTS", ['up', 'down', 'stop', 'prog'])
+        self.code_store = RollingCodeStore(self.code_store_filename) if code_store is None else code_store
 
     def new_instance(self, parameters: {}):
-        code = int(parameters['code'])
         remote = int(parameters['remote'])
-        instance = SomfyRemoteInstance(code, remote)
+        # the stored code is more recent than the initial code
+        code = self.code_store.get(remote, int(parameters['code']))
+        instance = SomfyRemoteInstance(code, remote, self.code_store)
         self.add_instance(instance)
+        return instance
+
+    def to_key(self, instance_id):
+        return int(instance_id)
+
+    # stores the exact rolling codes, see RollingCodeStore
+    def close(self):
+        self.code_store.close()
 
     def parse(self, timestamp, pulses):
-        if 8704 * 0.85 <= sum(pulses) <= 8704 * 1.15:
-            # could be an RTS message, continue from here
-            if 24 * self.pulse_time * 0.85 <= sum(pulses[0:5]) <= 24 * self.pulse_time * 1.15:
-                bits = RFLinkTools.decode_manchester(pulses[5:], 64, 1)
-                bytes = RFLinkTools.bits_to_bytes(bits)
-                cmd = RtsCommand()
-                cmd.decode(bytes)
-                is_handled = False
-                for i in self.instances:
-                    if i.get_id() == str(cmd.remote):
-                        i.handle(cmd)
-                        is_handled = True
-                if not is_handled:
-                    logging.info("Somfy RTS (unknown remote): remote:{remote} code:{code} button:{button}".format(
-                        remote=cmd.remote,
-                        code=cmd.code,
-                        button=cmd.button))
-                return True
-        return False
+        value = self.protocol.decode(pulses)
+        if value is None:
+            return False
+        cmd = RtsCommand()
+        cmd.decode_int(value, self.protocol.bits)
+        if self.deduplicator.is_duplicate((cmd.remote, cmd.button, cmd.code)):
+            return True
+        instance = self.lookup(cmd.remote)
+        if instance is not None:
+            instance.handle(timestamp, cmd)
+        else:
+            log.info('Somfy RTS (unknown remote): remote:%s code:%s button:%s', cmd.remote, cmd.code, cmd.button)
+        self.publish(timestamp, cmd.remote, 'button', button=cmd.button, code=cmd.code,
+                     known=instance is not None)
+        return True
 
 
 class RtsCommand:
-    data = bytearray(7)
-    button = 0
-    code = 0
-    remote = 0
+    def __init__(self):
+        self.data = bytearray(7)
+        self.button = 0
+        self.code = 0
+        self.remote = 0
 
     def encode(self, button: BlindButtons, code, remote):
         self.button = button
@@ -163,6 +181,16 @@ class RtsCommand:
         self.code = (self.data[2] << 8) | self.data[3]
         self.remote = (self.data[4] << 16) | (self.data[5] << 8) | self.data[6]
 
+    # decodes a frame given as an integer bitfield
+    def decode_int(self, value, nbits):
+        if nbits != 56:
+            raise Exception("invalid data length")
+        self.decode(RFLinkTools.int_to_bytes(value, nbits))
+
+    # returns the (obfuscated) frame as an integer bitfield and its bit count
+    def to_int(self):
+        return RFLinkTools.bytes_to_int(self.data)
+
     def __checksum(self) -> int:
         checksum = 0
         for byte in self.data:
@@ -175,7 +203,8 @@ class RtsCommand:
             self.data[i] = self.data[i] ^ self.data[i - 1]
 
     def __decipher(self):
-        data = [self.data[0], 0, 0, 0, 0, 0, 0]
+        data = bytearray(7)
+        data[0] = self.data[0]
         for i in range(1, 7):
             data[i] = self.data[i] ^ self.data[i - 1]
         self.data = data
@@ -0,0 +1,162 @@
+import serial
+import asyncio
+import logging
+import os
+import time
+import Metrics
+import RFLinkTools
+import Framer
+from Scheduler import TransmitScheduler
+
+rx_bytes = Metrics.counter('rflink_serial_rx_bytes_total', 'Bytes received from the serial port', ('port',))
+tx_bytes = Metrics.counter('rflink_serial_tx_bytes_total', 'Bytes written to the serial port', ('port',))
+
+log = logging.getLogger(__name__)
+
+
+# One RFLink-alt stick: its serial port, the framer of the received data and
+# its own transmit queue, so a slow or busy stick does not hold up the others.
+# name is the serial port, or a pyserial URL, e.g. socket://localhost:7777
+#
+# Commands are sent as t: messages, or in the binary form of
+# RFLinkTools.encode_binary when the firmware supports it: after opening
+# the port the gateway asks for the features of the firmware with "c:?",
+# firmware that answers with a "c:" line that lists "binary" accepts binary
+# messages. Until then, or without an answer, the t: messages are used.
+class Transceiver:
+    # seconds a scheduler thread waits for the asyncio writer to send a command
+    send_timeout = 5.0
+    # use the binary messages when the firmware supports them
+    binary_tx = True
+    # seconds to wait for the features of the firmware
+    negotiate_timeout = 2.0
+
+    def __init__(self, name: str):
+        self.name = name
+        self.serial_port = None
+        self.framer = Framer.Framer()
+        self.scheduler = TransmitScheduler(self.send)
+        # the firmware accepts binary messages
+        self.binary = False
+        # time until which the received lines are checked for the features, see read
+        self.negotiating = None
+
+        # asyncio mode, see open_async
+        self.loop = None
+        self.tx_queue = None
+
+    def open(self, timeout=0.1):
+        log.info('Opening COM port ' + self.name)
+        self.serial_port = serial.serial_for_url(self.name, 57600, timeout=timeout)
+        self.binary = False
+        if self.binary_tx:
+            self.negotiating = time.monotonic() + self.negotiate_timeout
+            self.serial_port.write(b'c:?\n')
+
+    def close(self):
+        self.scheduler.stop()
+        if self.serial_port is not None:
+            log.debug('Closing COM port: ' + self.name)
+            self.serial_port.close()
+            self.serial_port = None
+
+    # reads the available data, blocks until the port timeout when there is none
+    # returns the complete lines, valid until the next read
+    def read(self):
+        count = self.framer.read(self.serial_port)
+        if Metrics.enabled and count:
+            rx_bytes.inc(self.name, amount=count)
+        if self.negotiating is not None:
+            return self.__negotiate(self.framer.lines())
+        return self.framer.lines()
+
+    # takes the answer to "c:?" out of the received lines
+    def __negotiate(self, lines):
+        for line in lines:
+            if line[0:2] == b'c:':
+                features = bytes(line[2:]).strip().split(b',')
+                self.binary = b'binary' in features
+                self.negotiating = None
+                log.info('Firmware on %s: %s, %s commands', self.name,
+                         bytes(line[2:]).strip().decode('ascii', 'replace'), 'binary' if self.binary else 't:')
+                continue
+            yield line
+        if self.negotiating is not None and time.monotonic() > self.negotiating:
+            log.info('Firmware on %s did not answer c:?, t: commands', self.name)
+            self.negotiating = None
+
+    # sends pulses or a TxFrame
+    def send(self, frame):
+        if self.loop is not None:
+            # asyncio mode: hand the command to the writer task and wait until it is sent
+            asyncio.run_coroutine_threadsafe(self.send_async(frame), self.loop).result(self.send_timeout)
+        else:
+            if not isinstance(frame, RFLinkTools.TxFrame):
+                frame = RFLinkTools.TxFrame(frame)
+            data = frame.encode(self.binary)
+            log.info('Sending command on %s: %s', self.name, data)
+            self.serial_port.write(data)
+            if Metrics.enabled:
+                tx_bytes.inc(self.name, amount=len(data))
+
+    # asyncio mode: opens the port and returns the writer task
+    def open_async(self, loop):
+        self.open(timeout=0)
+        self.loop = loop
+        self.tx_queue = asyncio.Queue()
+        return loop.create_task(self.__writer())
+
+    def close_async(self):
+        self.loop = None
+        self.tx_queue = None
+        self.close()
+
+    # reads the available data whenever the port is readable, yields the complete lines
+    async def lines_async(self):
+        fd = self.serial_port.fileno()
+        readable = asyncio.Event()
+        self.loop.add_reader(fd, readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                for line in self.read():
+                    yield line
+        finally:
+            self.loop.remove_reader(fd)
+
+    # queues a command for the writer task, completes when it has been written
+    async def send_async(self, frame):
+        if not isinstance(frame, RFLinkTools.TxFrame):
+            frame = RFLinkTools.TxFrame(frame)
+        data = frame.encode(self.binary)
+        log.info('Sending command on %s: %s', self.name, data)
+        done = self.loop.create_future()
+        await self.tx_queue.put((data, done))
+        return await done
+
+    async def __writer(self):
+        while True:
+            data, done = await self.tx_queue.get()
+            try:
+                await self.__write_async(data)
+                done.set_result(True)
+            except Exception as e:
+                done.set_exception(e)
+
+    async def __write_async(self, data):
+        fd = self.serial_port.fileno()
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                n = os.write(fd, view)
+                view = view[n:]
+                if Metrics.enabled:
+                    tx_bytes.inc(self.name, amount=n)
+            except BlockingIOError:
+                writable = self.loop.create_future()
+                self.loop.add_writer(fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(fd)
@@ -0,0 +1,206 @@
+# Randomized equivalence check of the compiled protocol decoders against the
+# scalar reference decoders of RFLinkTools.
+#
+# Encoded frames of every protocol get timing jitter, pulses exactly on the
+# bounds of a pulse length, truncation, a missing or an extra pulse, and a
+# corrupted pulse. Protocol.decode must return the same value as the length,
+# sync and header checks followed by RFLinkTools.decode_two_state_int or
+# decode_manchester_int, and the same as the per pulse decoder. It reports
+# how many frames were decoded and how many took the per pulse path (a
+# pulse in a symbol that straddles a bound), so both paths are covered.
+#
+# The payload pulses of the same frames are also decoded in batches with
+# RFLinkBatch (requires numpy), which must match the scalar decoders exactly:
+# the same frames are invalid, and the same value and number of bits for
+# the others.
+#
+# usage: python benchmarks/equivalence.py [--frames 20000] [--seed 1]
+# exits with 1 on the first mismatch
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import Framer
+import Protocol
+import RFLinkTools
+from RA20RF import RA20RFType
+from SomfyRTS import SomfyRemoteType
+
+protocol_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'protocols')
+
+
+def protocols():
+    result = [RA20RFType.protocol, SomfyRemoteType.protocol]
+    for filename in sorted(os.listdir(protocol_directory)):
+        if filename.endswith('.json'):
+            with open(os.path.join(protocol_directory, filename)) as f:
+                result.append(Protocol.Protocol(json.load(f)))
+    return result
+
+
+# the payload of the received pulses as the scalar decoders see it, None if it does not match
+def reference_decode(protocol, pulses):
+    if protocol.length_bounds is not None:
+        low, high = protocol.length_bounds
+        if not low <= sum(pulses) <= high:
+            return None
+    if protocol.sync_bounds is not None:
+        low, high = protocol.sync_bounds
+        if not low <= sum(pulses[:protocol.start]) <= high:
+            return None
+    else:
+        for pulse, (low, high) in zip(pulses, protocol.header_bounds):
+            if not low <= pulse <= high:
+                return None
+    start = protocol.start
+    descriptor = protocol.descriptor
+    try:
+        if protocol.encoding == 'two_state':
+            if len(pulses) != start + 2 * protocol.bits + len(protocol.footer):
+                return None
+            value, nbits = RFLinkTools.decode_two_state_int(pulses[start:start + 2 * protocol.bits],
+                                                            protocol.pulse_time, descriptor['symbols'],
+                                                            protocol.tolerance)
+        else:
+            value, nbits = RFLinkTools.decode_manchester_int(pulses[start:], protocol.pulse_time, protocol.last_bit)
+    except Exception:
+        return None
+    return value if nbits == protocol.bits else None
+
+
+# the received pulses of a random payload
+def encoded(protocol, rnd):
+    value = rnd.getrandbits(protocol.bits)
+    static = bytes(protocol.descriptor.get('static', []))
+    if static:
+        shift = protocol.bits - 8 * len(static)
+        value = int.from_bytes(static, 'big') << shift | value & (1 << shift) - 1
+    return protocol.encode(value).pulses[2:]
+
+
+# the pulse lengths just inside and outside of the bounds of the protocol
+def edges(protocol):
+    units = {1, 2} if protocol.encoding == 'manchester' else {u for b in protocol.descriptor['symbols'].values() for u in b}
+    result = []
+    for u in units:
+        low, high = protocol.bounds(u * protocol.pulse_time)
+        result += [low - 1, low, high, high + 1]
+    return result
+
+
+def mutated(protocol, pulses, rnd, edge_pulses):
+    jitter = rnd.choice([0.0, 0.03, 0.1, 0.15, 0.2, 0.3])
+    pulses = [max(1, int(p * rnd.uniform(1.0 - jitter, 1.0 + jitter))) for p in pulses]
+    for _ in range(rnd.choice([0, 0, 1, 3])):
+        pulses[rnd.randrange(len(pulses))] = rnd.choice(edge_pulses)
+    mutation = rnd.random()
+    if mutation < 0.05:
+        pulses = pulses[:rnd.randrange(len(pulses))]
+    elif mutation < 0.1:
+        del pulses[rnd.randrange(len(pulses))]
+    elif mutation < 0.15:
+        pulses.insert(rnd.randrange(len(pulses) + 1), rnd.randrange(1, 3 * protocol.pulse_time))
+    elif mutation < 0.2:
+        pulses[rnd.randrange(len(pulses))] = rnd.randrange(1, 20000)
+    return pulses
+
+
+# True when the frame is decoded pulse by pulse instead of with its symbols
+def per_pulse(protocol, frame):
+    return Protocol.mixed_byte in frame.symbols[protocol.start:].translate(protocol.symbol_masks)
+
+
+def check_protocol(protocol, frames, rnd):
+    if protocol.encoding == 'manchester' and protocol.tolerance != 0.15:
+        # decode_manchester_int has a fixed tolerance of 15%
+        print('{name:<12} skipped, tolerance is not 0.15'.format(name=protocol.name))
+        return True
+    edge_pulses = edges(protocol)
+    decode_pulses = getattr(protocol, '_Protocol__decode_{e}_pulses'.format(e=protocol.encoding))
+    decoded = slow = 0
+    for _ in range(frames):
+        pulses = mutated(protocol, encoded(protocol, rnd), rnd, edge_pulses)
+        frame = Framer.to_frame(pulses)
+        value = protocol.decode(frame)
+        expected = reference_decode(protocol, pulses)
+        if value != expected:
+            print('{name}: {value} instead of {expected} for {pulses}'.format(
+                name=protocol.name, value=value, expected=expected, pulses=pulses))
+            return False
+        # the per pulse decoder on its own, for frames that pass the header checks
+        if expected is not None and decode_pulses(frame) != expected:
+            print('{name}: per pulse decoder differs for {pulses}'.format(name=protocol.name, pulses=pulses))
+            return False
+        decoded += value is not None
+        slow += per_pulse(protocol, frame)
+    print('{name:<12} frames {frames}  decoded {decoded}  per pulse {slow}'.format(
+        name=protocol.name, frames=frames, decoded=decoded, slow=slow))
+    return True
+
+
+# the payload pulses of random frames in batches of batch_size
+def check_batch(protocol, frames, rnd, batch_size=1000):
+    try:
+        import numpy as np
+        import RFLinkBatch
+    except ImportError:
+        print('{name:<12} batch skipped, numpy is not installed'.format(name=protocol.name))
+        return True
+    edge_pulses = edges(protocol)
+    start = protocol.start
+    valid_frames = 0
+    for first in range(0, frames, batch_size):
+        payloads = []
+        for _ in range(min(batch_size, frames - first)):
+            pulses = mutated(protocol, encoded(protocol, rnd), rnd, edge_pulses)
+            if protocol.encoding == 'two_state':
+                payloads.append(pulses[start:start + 2 * protocol.bits])
+            else:
+                payloads.append(pulses[start:])
+        padded, lengths = RFLinkBatch.pad_frames(payloads)
+        offsets = np.concatenate(([0], np.cumsum([len(p) for p in payloads])))
+        ragged, ragged_lengths = RFLinkBatch.from_ragged(offsets, [p for payload in payloads for p in payload])
+        if not (np.array_equal(padded, ragged) and np.array_equal(lengths, ragged_lengths)):
+            print('{name}: from_ragged differs from pad_frames'.format(name=protocol.name))
+            return False
+        if protocol.encoding == 'two_state':
+            bits, nbits, valid = RFLinkBatch.decode_two_state(padded, lengths, protocol.pulse_time,
+                                                              protocol.descriptor['symbols'], protocol.tolerance)
+        else:
+            bits, nbits, valid = RFLinkBatch.decode_manchester(padded, lengths, protocol.pulse_time,
+                                                               protocol.last_bit)
+        values = RFLinkBatch.to_int(bits, nbits, valid)
+        for payload, value, n in zip(payloads, values, nbits):
+            try:
+                if protocol.encoding == 'two_state':
+                    expected = RFLinkTools.decode_two_state_int(payload, protocol.pulse_time,
+                                                                protocol.descriptor['symbols'], protocol.tolerance)
+                else:
+                    expected = RFLinkTools.decode_manchester_int(payload, protocol.pulse_time, protocol.last_bit)
+            except Exception:
+                expected = None
+            result = None if value is None else (value, int(n))
+            if result != expected:
+                print('{name}: batch {result} instead of {expected} for {payload}'.format(
+                    name=protocol.name, result=result, expected=expected, payload=payload))
+                return False
+            valid_frames += expected is not None
+    print('{name:<12} batch frames {frames}  valid {valid}'.format(name=protocol.name, frames=frames, valid=valid_frames))
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RFLink-alt-Gateway decoder equivalence check')
+    parser.add_argument('--frames', type=int, default=20000, help='random frames per protocol')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random frames')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    ok = all(check_protocol(protocol, args.frames, rnd) and check_batch(protocol, args.frames, rnd)
+             for protocol in protocols())
+    if not ok:
+        sys.exit(1)
@@ -0,0 +1,171 @@
+# End-to-end load test of the gateway against the RFLink-alt emulator.
+#
+# The gateway reads from an emulated stick while a separate process injects
+# a mix of received frames at increasing rates. Meanwhile a client sends
+# commands to the HTTP /command endpoint and the time until the emulator
+# receives the t: message is measured. For every rate it reports the frames
+# that were handled and dropped and the p50/p99 command latency; the highest
+# rate without drops is the sustained rate.
+#
+# usage: python benchmarks/load_test.py [--rates 250,500,1000,2000,4000] [--duration 5]
+# runs in a temporary directory, the gateway database is not touched
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import Emulator
+import Metrics
+
+somfy_remotes = [0x0F0101 + i for i in range(8)]
+ra20rf_ids = [0x12D687 + i for i in range(8)]
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+# frames handled by the gateway, valid or not
+def handled():
+    import Gateway
+    return sum(Gateway.frames.values.values()) + sum(Gateway.invalid_frames.values.values())
+
+
+def inject_process(emulator, lines, rate, duration, split, results):
+    written = emulator.inject(lines, rate, duration, split=split, seed=1)
+    results.put((sum(1 for line in written if line.startswith(b'r:')), emulator.dropped))
+
+
+# sends commands one at a time until stopped, returns the latencies in seconds
+class CommandClient:
+    def __init__(self, url, emulator, interval):
+        self.url = url
+        self.emulator = emulator
+        self.interval = interval
+        self.latencies = []
+        self.failed = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __run(self):
+        n = 0
+        while self.running:
+            remote = somfy_remotes[n % len(somfy_remotes)]
+            n += 1
+            start = time.monotonic()
+            try:
+                with urllib.request.urlopen('{url}/command/SomfyRTS/{remote}/up'.format(url=self.url, remote=remote),
+                                            timeout=10) as response:
+                    response.read()
+                sent = self.emulator.wait_transmit(start, timeout=5)
+                if sent is None:
+                    self.failed += 1
+                else:
+                    self.latencies.append(sent[0] - start)
+            except Exception:
+                self.failed += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return self.latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RFLink-alt-Gateway load test')
+    parser.add_argument('--rates', default='250,500,1000,2000,4000', help='injected lines per second, per step')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per step')
+    parser.add_argument('--split', type=float, default=0.05, help='share of lines written in two parts')
+    parser.add_argument('--interval', type=float, default=0.05, help='seconds between commands')
+    parser.add_argument('--asyncio', action='store_true', help='run the gateway on an asyncio event loop')
+    parser.add_argument('--binary-tx', action='store_true', help='the emulated stick accepts binary commands')
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='rflink-load-'))
+    import main as gateway_main
+    from werkzeug.serving import make_server
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    Metrics.enabled = True
+
+    gateway = gateway_main.gateway
+    gateway.add_device_type('RA20RF', 'RA20RFType')
+    gateway.add_device_type('SomfyRTS', 'SomfyRemoteType')
+    for device_id in ra20rf_ids:
+        gateway.add_device_instance('RA20RF', {'device_id': str(device_id)})
+    for remote in somfy_remotes:
+        gateway.add_device_instance('SomfyRTS', {'remote': str(remote), 'code': '1'})
+
+    emulator = Emulator.Emulator(binary=args.binary_tx)
+    if args.asyncio:
+        import asyncio
+        runner = threading.Thread(target=lambda: asyncio.run(gateway.run_async(emulator.port)), daemon=True)
+    else:
+        runner = threading.Thread(target=gateway.run, args=(emulator.port,), daemon=True)
+    runner.start()
+    server = make_server('127.0.0.1', 0, gateway_main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{port}'.format(port=server.server_port)
+    time.sleep(0.5)
+    # the commands of the test must not run into the airtime budget
+    for transceiver in gateway.transceivers:
+        transceiver.scheduler.airtime_budget = float('inf')
+
+    print('{:>8} {:>10} {:>10} {:>8} {:>9} {:>9} {:>9}'.format(
+        'rate/s', 'frames/s', 'handled/s', 'dropped', 'p50 ms', 'p99 ms', 'commands'))
+    sustained = 0
+    traffic = Emulator.Traffic(ra20rf_ids=ra20rf_ids, somfy_remotes=somfy_remotes, seed=1)
+    context = multiprocessing.get_context('fork')
+    for rate in [int(r) for r in args.rates.split(',')]:
+        lines = [traffic.next()[1] for _ in range(int(rate * args.duration))]
+        before = handled()
+        client = CommandClient(url, emulator, args.interval)
+        client.start()
+        results = context.Queue()
+        injector = context.Process(target=inject_process,
+                                   args=(emulator, lines, rate, args.duration, args.split, results))
+        start = time.monotonic()
+        injector.start()
+        frames, dropped = results.get()
+        injector.join()
+        elapsed = time.monotonic() - start
+        latencies = client.stop()
+
+        # wait until the gateway has caught up
+        count = handled()
+        while True:
+            time.sleep(0.5)
+            if handled() == count:
+                break
+            count = handled()
+        count -= before
+        lost = dropped + max(0, frames - count)
+        print('{:>8} {:>10.0f} {:>10.0f} {:>8} {:>9.2f} {:>9.2f} {:>9}'.format(
+            rate, frames / elapsed, count / elapsed, lost, 1e3 * percentile(latencies, 50),
+            1e3 * percentile(latencies, 99), len(latencies)))
+        if lost == 0 and len(lines) / elapsed >= 0.95 * rate:
+            sustained = rate
+    print('sustained without drops: {rate} lines/s'.format(rate=sustained))
+    if emulator.transmitted:
+        print('bytes per command: {size:.0f}'.format(size=emulator.transmitted_bytes / len(emulator.transmitted)))
+
+    gateway.stop()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+# Micro-benchmarks of the codec, the protocol parsers and the dispatch of
+# received messages, compared with the committed baseline.json.
+#
+# Every benchmark reports the best time per call out of a few repeats. The
+# times are scaled by a reference benchmark (a plain python loop) before they
+# are compared, so a baseline made on another machine is still meaningful.
+# The script fails when a benchmark got slower than the baseline by more than
+# the threshold, a result over the threshold is measured again first.
+#
+# usage: python benchmarks/micro.py [--filter NAME] [--threshold 0.25] [--save]
+# runs in a temporary directory, the gateway database is not touched
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import Framer
+import Protocol
+import RFLinkTools
+from RA20RF import RA20RFType, RA20RFInstance
+from SomfyRTS import SomfyRemoteType, SomfyRemoteInstance, RtsCommand, BlindButtons
+
+# the temporary directory the benchmarks run in
+root = None
+
+baseline_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+benchmarks = {}  # name -> function that returns the function to time
+
+
+def benchmark(name):
+    def register(setup):
+        benchmarks[name] = setup
+        return setup
+    return register
+
+
+def frame_line(pulses):
+    return ('r:{n}:'.format(n=len(pulses)) + ','.join(str(p) for p in pulses)).encode('utf-8')
+
+
+# realistic received frames: a transmitted frame with some timing jitter
+# a frame caches its quantization, the benchmarks time a fresh copy per call
+def received(pulses, seed=1):
+    import random
+    rnd = random.Random(seed)
+    return Framer.parse_pulses(frame_line([int(p * rnd.uniform(0.95, 1.05)) for p in pulses[2:]]))
+
+
+ra20rf_frame = received(RA20RFInstance(0x12D687).alarm().pulses)
+somfy_frame = received(SomfyRemoteInstance(0x1000, 0x0F0101).up().pulses)
+unknown_frame = received([1, 1] + [300, 900, 900, 300] * 16 + [300, 9000])
+somfy_data = RtsCommand()
+somfy_data.encode(BlindButtons.up, 0x1001, 0x0F0101)
+somfy_bits = RFLinkTools.bytes_to_bits(somfy_data.data)
+somfy_preamble = [4 * 64] * 4 + [7 * 64, 64]
+
+
+@benchmark('reference')
+def reference():
+    def run():
+        total = 0
+        for i in range(100):
+            total += i
+        return total
+    return run
+
+
+@benchmark('codec/bytes_to_bits')
+def bytes_to_bits():
+    return lambda: RFLinkTools.bytes_to_bits(somfy_data.data)
+
+
+@benchmark('codec/bits_to_bytes')
+def bits_to_bytes():
+    return lambda: RFLinkTools.bits_to_bytes(somfy_bits)
+
+
+@benchmark('codec/encode_manchester')
+def encode_manchester():
+    return lambda: RFLinkTools.encode_manchester(somfy_bits, 64, somfy_preamble)
+
+
+@benchmark('codec/decode_manchester')
+def decode_manchester():
+    pulses = somfy_frame[5:]
+    return lambda: RFLinkTools.decode_manchester(pulses, 64, 1)
+
+
+@benchmark('codec/encode_two_state')
+def encode_two_state():
+    bits = RFLinkTools.bytes_to_bits([0x12, 0xD6, 0x87])
+    return lambda: RFLinkTools.encode_two_state(bits, 800, {'0': [1, 2], '1': [1, 3]})
+
+
+@benchmark('codec/decode_two_state')
+def decode_two_state():
+    pulses = ra20rf_frame[2:50]
+    return lambda: RFLinkTools.decode_two_state(pulses, 800, {'0': [1, 2], '1': [1, 3]}, 0.25)
+
+
+@benchmark('codec/RtsCommand.encode')
+def rts_encode():
+    return lambda: RtsCommand().encode(BlindButtons.up, 0x1001, 0x0F0101)
+
+
+@benchmark('codec/RtsCommand.decode')
+def rts_decode():
+    return lambda: RtsCommand().decode(somfy_data.data)
+
+
+@benchmark('frame/quantize')
+def quantize():
+    return lambda: Framer.Frame('H', somfy_frame).symbols
+
+
+@benchmark('protocol/RA20RF.decode')
+def ra20rf_decode():
+    return lambda: RA20RFType.protocol.decode(Framer.Frame('H', ra20rf_frame))
+
+
+@benchmark('protocol/SomfyRTS.decode')
+def somfy_decode():
+    return lambda: SomfyRemoteType.protocol.decode(Framer.Frame('H', somfy_frame))
+
+
+@benchmark('tx/SomfyRTS.up')
+def somfy_up():
+    instance = SomfyRemoteInstance(0x1000, 0x0F0101)
+    return lambda: instance.up().encode()
+
+
+@benchmark('tx/RA20RF.alarm')
+def ra20rf_alarm():
+    return lambda: RA20RFInstance(0x12D687).alarm().encode()
+
+
+@benchmark('parse/RA20RFType')
+def ra20rf_parse():
+    dt = RA20RFType()
+    dt.new_instance({'device_id': str(0x12D687)})
+    # every frame is handled, not dropped as a repeat
+    dt.deduplicator.window = 0
+    now = time.monotonic_ns()
+    return lambda: dt.parse(now, Framer.Frame('H', ra20rf_frame))
+
+
+@benchmark('parse/SomfyRemoteType')
+def somfy_parse():
+    dt = SomfyRemoteType()
+    dt.new_instance({'remote': str(0x0F0101), 'code': '1'})
+    dt.deduplicator.window = 0
+    now = time.monotonic_ns()
+    return lambda: dt.parse(now, Framer.Frame('H', somfy_frame))
+
+
+# descriptors of device types that share the bands and pulse counts of the real ones
+def synthetic_descriptor(i):
+    return {'name': 'Synthetic{i}'.format(i=i),
+            'encoding': 'two_state',
+            'pulse_time': 100 + 7 * i,
+            'header': [12 + i % 5, 1],
+            'bits': 12 + i % 16,
+            'symbols': {'0': [1, 3], '1': [3, 1]},
+            'footer': [1, 20]}
+
+
+# a gateway with the given number of device types and instances (RA20RF and
+# Somfy), handles a RA20RF, a Somfy and an unknown message per call
+def dispatch(types, instances):
+    from Gateway import Gateway
+    # every gateway has its own database
+    os.chdir(tempfile.mkdtemp(prefix='types{t}-instances{i}-'.format(t=types, i=instances), dir=root))
+    gateway = Gateway()
+    gateway.add_device_type('RA20RF', 'RA20RFType')
+    if types > 1:
+        gateway.add_device_type('SomfyRTS', 'SomfyRemoteType')
+    os.makedirs(Protocol.directory, exist_ok=True)
+    for i in range(types - 2):
+        descriptor = synthetic_descriptor(i)
+        with open(os.path.join(Protocol.directory, descriptor['name'] + '.json'), 'w') as f:
+            json.dump(descriptor, f)
+        gateway.add_device_type('protocols', descriptor['name'])
+    ra20rf = gateway.get_device_type('RA20RF')
+    somfy = gateway.get_device_type('SomfyRTS')
+    with ra20rf.bulk_update():
+        for i in range(instances // 2 if somfy is not None else instances):
+            ra20rf.new_instance({'device_id': str(0x12D687 - i)})
+    if somfy is not None:
+        with somfy.bulk_update():
+            for i in range(instances // 2):
+                somfy.new_instance({'remote': str(0x0F0101 - i), 'code': '1'})
+    for dt in gateway.device_types:
+        dt.deduplicator.window = 0
+    lines = [frame_line(ra20rf_frame), frame_line(somfy_frame), frame_line(unknown_frame)]
+    handle = gateway._Gateway__handle_message
+
+    def run():
+        for line in lines:
+            handle(line)
+    return run
+
+
+for types in (1, 10, 100):
+    for instances in (10, 1000):
+        benchmark('dispatch/types={t},instances={i}'.format(t=types, i=instances))(
+            lambda types=types, instances=instances: dispatch(types, instances))
+
+
+# best time per call in microseconds
+def measure(function, repeat=5, min_time=0.05):
+    number = 1
+    while True:
+        t = timeit.timeit(function, number=number)
+        if t >= min_time:
+            break
+        number *= 2 if t <= 0 else max(2, min(10, int(min_time / t) + 1))
+    return 1e6 * min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RFLink-alt-Gateway micro-benchmarks')
+    parser.add_argument('--filter', default='', help='only run the benchmarks with this in their name')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fail when a benchmark is slower than the baseline by more than this fraction')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    global root
+    root = tempfile.mkdtemp(prefix='rflink-bench-')
+    os.chdir(root)
+
+    baseline = {}
+    if os.path.exists(baseline_filename):
+        with open(baseline_filename) as f:
+            baseline = json.load(f)
+
+    reference = benchmarks['reference']()
+    results = {}
+    for name, setup in benchmarks.items():
+        if name == 'reference' or args.filter not in name:
+            continue
+        function = setup()
+        results[name] = measure(function)
+        # a result that looks slower is measured once more, to rule out noise
+        if name in baseline and results[name] > baseline[name] * (1.0 + args.threshold):
+            results[name] = min(results[name], measure(function))
+    # the speed of this machine relative to the one that made the baseline,
+    # measured before and after the benchmarks as the speed of a shared
+    # machine varies
+    results['reference'] = min(measure(reference), measure(reference))
+    scale = results['reference'] / baseline['reference'] if 'reference' in baseline else 1.0
+
+    print('{:<36} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline us', 'current us', 'change'))
+    regressions = []
+    for name in benchmarks:
+        if name not in results or name == 'reference':
+            continue
+        if name in baseline:
+            expected = baseline[name] * scale
+            change = results[name] / expected - 1.0
+            if change > args.threshold:
+                regressions.append(name)
+            print('{:<36} {:>12.2f} {:>12.2f} {:>+7.0%}{flag}'.format(
+                name, expected, results[name], change, flag=' !' if change > args.threshold else ''))
+        else:
+            print('{:<36} {:>12} {:>12.2f}'.format(name, '-', results[name]))
+
+    if args.save:
+        # in the units of the existing baseline, so that a run with --filter
+        # only adds or replaces its own benchmarks
+        saved = {**baseline, **{name: t / scale for name, t in results.items() if name != 'reference'}}
+        saved.setdefault('reference', results['reference'])
+        with open(baseline_filename, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('saved ' + baseline_filename)
+    elif regressions:
+        print('slower than the baseline: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
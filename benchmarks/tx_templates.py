@@ -0,0 +1,64 @@
+# Compares the precompiled transmit templates with encoding every frame from
+# scratch, as the device instances did before.
+#
+# usage: python benchmarks/tx_templates.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import RFLinkTools
+from RA20RF import RA20RFType, RA20RFInstance
+from SomfyRTS import SomfyRemoteType, SomfyRemoteInstance, RtsCommand, BlindButtons
+
+
+def somfy_from_scratch(instance):
+    preamble = []
+    for i in range(0, 4):
+        preamble.append(4 * 64)
+    preamble.append(7 * 64)
+    preamble.append(1 * 64)
+
+    instance.code += 1
+    cmd = RtsCommand()
+    cmd.encode(BlindButtons.up, instance.code, instance.remote)
+    bits = RFLinkTools.bytes_to_bits(cmd.data)
+    pulses = SomfyRemoteType.protocol.control + RFLinkTools.encode_manchester(bits, 64, preamble)
+    return ('t:' + RFLinkTools.pulses_to_string(pulses) + '\n').encode('utf-8')
+
+
+def somfy_template(instance):
+    return instance.up().encode()
+
+
+def ra20rf_from_scratch(instance):
+    bits = RFLinkTools.bytes_to_bits(instance.device_id)
+    pulses = RA20RFType.protocol.control + \
+             [10 * 800, 800] + \
+             RFLinkTools.encode_two_state(bits, 800, {'0': [1, 2], '1': [1, 3]}) + \
+             [800, 800 * 16]
+    return ('t:' + RFLinkTools.pulses_to_string(pulses) + '\n').encode('utf-8')
+
+
+def ra20rf_template(instance):
+    return instance.alarm().encode()
+
+
+def bench(name, function, instance, number=20000):
+    seconds = min(timeit.repeat(lambda: function(instance), number=number, repeat=5))
+    print('{name:<24} {us:8.2f} us/command'.format(name=name, us=1e6 * seconds / number))
+    return seconds
+
+
+if __name__ == '__main__':
+    assert somfy_from_scratch(SomfyRemoteInstance(0x1000, 0x0F0101)) == \
+        somfy_template(SomfyRemoteInstance(0x1000, 0x0F0101))
+    assert ra20rf_from_scratch(RA20RFInstance(0x12D687)) == ra20rf_template(RA20RFInstance(0x12D687))
+
+    before = bench('somfy from scratch', somfy_from_scratch, SomfyRemoteInstance(0x1000, 0x0F0101))
+    after = bench('somfy template', somfy_template, SomfyRemoteInstance(0x1000, 0x0F0101))
+    print('{gain:.1f}x faster'.format(gain=before / after))
+    before = bench('ra20rf from scratch', ra20rf_from_scratch, RA20RFInstance(0x12D687))
+    after = bench('ra20rf cached frame', ra20rf_template, RA20RFInstance(0x12D687))
+    print('{gain:.1f}x faster'.format(gain=before / after))
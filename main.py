@@ -1,14 +1,31 @@
 from Gateway import Gateway
+from HttpCache import JsonCache
+from Transceiver import Transceiver
+import Metrics
+import LogPipeline
 import logging
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 import threading
 import argparse
-import time
+import asyncio
 
 
 logging.getLogger().setLevel(logging.DEBUG)
 gateway = Gateway()
 app = Flask(__name__)
+cache = JsonCache()
+# an /events stream holds an HTTP worker thread for as long as it is open,
+# with a fixed number of worker threads (waitress) the number of streams is
+# limited so that other requests are still served, None is no limit
+event_streams = None
+
+Metrics.gauge('rflink_transmit_queue_depth', 'Commands waiting in the transmit queue', gateway.transmit_depth)
+Metrics.gauge('rflink_dedup_dropped', 'Repeated transmissions that were dropped',
+              lambda: sum(dt.deduplicator.dropped for dt in gateway.device_types))
+Metrics.gauge('rflink_dropped_lines', 'Received partial lines that were too long and dropped',
+              lambda: sum(t.framer.dropped for t in gateway.transceivers))
+Metrics.gauge('rflink_unknown_signatures', 'Distinct signatures of the unrecognized frames',
+              lambda: len(gateway.get_device_type('Unknown').signals.entries))
 
 
 @app.route('/')
@@ -19,26 +36,56 @@ def index():
 @app.route('/command/<device_type>/<device_id>/<command>', methods=['GET'])
 def command(device_type, device_id, command):
     try:
-        dt = gateway.get_device_type(device_type)
-        if dt is None:
-            raise Exception('no such device type')
-        pulses = dt.execute_command(command, device_id, command)
-        gateway.send(pulses)
+        gateway.command(device_type, device_id, command).result(gateway.send_timeout)
         return jsonify(result=True, error='')
+    except Exception as e:
+        logging.error('command execution failed' + str(e))
+        return jsonify(result=False, error=str(e) or 'not sent')
+
+
+# executes a list of commands in one burst, the body is a JSON list of
+# {"device_type": .., "id": .., "command": ..} where id "*" is every instance of the type,
+# or {"group": .., "command": ..}
+@app.route('/commands', methods=['POST'])
+def commands():
+    try:
+        items = request.get_json(force=True)
+        if not isinstance(items, list):
+            raise Exception('expected a list of commands')
+        results, queued = gateway.commands(items)
+        for result, future in queued:
+            try:
+                future.result(gateway.send_timeout)
+                result['result'] = True
+            except Exception as e:
+                result['error'] = str(e) or 'not sent'
+        return jsonify(result=all(r['result'] for r in results), error='', results=results)
     except Exception as e:
         logging.error('command execution failed' + str(e))
         return jsonify(result=False, error=str(e))
 
 
+# adds device instances to a named group, the body is a JSON list of {"device_type": .., "id": ..}
+@app.route('/add_group/<group>', methods=['POST'])
+def add_group(group):
+    try:
+        members = request.get_json(force=True)
+        gateway.add_group(group, [(m['device_type'], m['id']) for m in members])
+        return jsonify(result=True, error='')
+    except Exception as e:
+        logging.error('adding group failed' + str(e))
+        return jsonify(result=False, error=str(e))
+
+
 @app.route('/devices', methods=['GET'])
 def get_devices():
     try:
-        devices = {}
-        for device_type in gateway.device_types:
-            devices[device_type.type_name] = []
-            for device_instance in device_type.instances:
-                devices[device_type.type_name].append(device_instance.id)
-        return jsonify(result=True, error='', devices=devices)
+        def build():
+            devices = {}
+            for device_type in gateway.device_types:
+                devices[device_type.type_name] = [device_instance.id for device_instance in device_type.instances]
+            return dict(result=True, error='', devices=devices)
+        return cache.response('devices', gateway.get_version(), build)
     except Exception as e:
         logging.error('could not get devices' + str(e))
         return jsonify(result=False, error=str(e))
@@ -46,8 +93,8 @@ def get_devices():
 @app.route('/device_types', methods=['GET'])
 def get_device_types():
     try:
-        types = [t.type_name for t in gateway.device_types]
-        return jsonify(result=True, error='', device_types=types)
+        return cache.response('device_types', gateway.version,
+                              lambda: dict(result=True, error='', device_types=[t.type_name for t in gateway.device_types]))
     except Exception as e:
         logging.error('Error getting device types' + str(e))
         return jsonify(result=False, error=str(e))
@@ -64,10 +111,7 @@ def add_device_types(device_module, device_type):
 @app.route('/add_device/<device_type>', methods=['GET'])
 def add_device_instances(device_type):
     try:
-        dt = gateway.get_device_type(device_type)
-        if dt is None:
-            raise Exception('no such device type')
-        dt.new_instance(request.args)
+        gateway.add_device_instance(device_type, request.args.to_dict())
         return jsonify(result=True, error='')
     except Exception as e:
         logging.error('adding device instance failed' + str(e))
@@ -79,8 +123,8 @@ def get_device_instances(device_type):
         dt = gateway.get_device_type(device_type)
         if dt is None:
             raise Exception('no such device type')
-        instances = [i.id for i in dt.instances]
-        return jsonify(result=True, error='', instances=instances)
+        return cache.response(('device_instances', device_type), dt.version,
+                              lambda: dict(result=True, error='', instances=[i.id for i in dt.instances]))
     except Exception as e:
         logging.error('listing device instances failed' + str(e))
         return jsonify(result=False, error=str(e))
@@ -101,6 +145,76 @@ def get_device_state(device_type, device_id):
         return jsonify(result=False, error=str(e))
 
 
+# server-sent events of all decoded frames, optionally of one device type
+# responds with 503 when the maximum number of streams is open, see event_streams
+@app.route('/events', methods=['GET'])
+def get_events():
+    slots = event_streams
+    if slots is not None and not slots.acquire(blocking=False):
+        return jsonify(result=False, error='too many event streams'), 503
+    subscription = gateway.events.subscribe(device_type=request.args.get('device_type'))
+
+    def stream():
+        while True:
+            event = subscription.get(timeout=15.0)
+            if event is None:
+                yield b': keep-alive\n\n'
+            else:
+                yield event.sse()
+
+    # also called when the stream was never started
+    def close():
+        subscription.close()
+        if slots is not None:
+            slots.release()
+
+    response = Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    response.call_on_close(close)
+    return response
+
+
+# recent events of a device instance, optionally between start and end (seconds since the epoch)
+@app.route('/device_history/<device_type>/<device_id>', methods=['GET'])
+def get_device_history(device_type, device_id):
+    try:
+        dt = gateway.get_device_type(device_type)
+        if dt is None:
+            raise Exception('no such device type')
+        di = dt.get_instance(device_id)
+        start = request.args.get('start', type=float)
+        end = request.args.get('end', type=float)
+        return jsonify(result=True, error='', history=di.get_history(start, end))
+    except Exception as e:
+        logging.error('getting device history failed' + str(e))
+        return jsonify(result=False, error=str(e))
+
+
+# the most frequent signatures of the frames no device type recognized
+@app.route('/unknown_signals', methods=['GET'])
+def get_unknown_signals():
+    try:
+        signals = gateway.get_device_type('Unknown').signals
+        top = request.args.get('top', default=20, type=int)
+        return jsonify(result=True, error='', total=signals.total, signals=signals.top(top))
+    except Exception as e:
+        logging.error('getting unknown signals failed' + str(e))
+        return jsonify(result=False, error=str(e))
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(Metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/transmit_queue', methods=['GET'])
+def get_transmit_queue():
+    try:
+        return jsonify(result=True, error='', state=gateway.transmit_stats())
+    except Exception as e:
+        logging.error('getting transmit queue failed' + str(e))
+        return jsonify(result=False, error=str(e))
+
+
 # todo: move the list of commands to the device_type
 @app.route('/device_commands/<device_type>', methods=['GET'])
 def get_device_commands(device_type):
@@ -114,19 +228,54 @@ def get_device_commands(device_type):
         return jsonify(result=False, error=str(e))
 
 
-def thread_runner(host, port):
-    app.run(host=host, port=port)
+def thread_runner(host, port, server='development', threads=8):
+    if server == 'waitress':
+        # production WSGI server, all worker threads share the one gateway that owns the serial port
+        import waitress
+        waitress.serve(app, host=host, port=port, threads=threads)
+    else:
+        app.run(host=host, port=port, threaded=True)
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
-
     parser = argparse.ArgumentParser(description='RFLink-alt-Gateway')
-    parser.add_argument('serial', help='serial port')
+    parser.add_argument('serial', help='serial port, or a comma separated list of serial ports (not used with --replay)')
     parser.add_argument('host', help='interface to use')
     parser.add_argument('port', type=int, help='port to listen to')
     parser.add_argument('database', help='database file')
+    parser.add_argument('--asyncio', action='store_true', help='run the gateway on an asyncio event loop')
+    parser.add_argument('--metrics', action='store_true', help='collect the metrics served at /metrics')
+    parser.add_argument('--server', choices=['development', 'waitress'], default='development',
+                        help='HTTP server to use')
+    parser.add_argument('--threads', type=int, default=8, help='number of HTTP worker threads (waitress)')
+    parser.add_argument('--event-streams', type=int,
+                        help='maximum number of open /events streams, each holds a worker thread '
+                             '(waitress, default: half of --threads)')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='DEBUG',
+                        help='lowest level that is logged')
+    parser.add_argument('--log-rate', type=float, default=10.0,
+                        help='messages per second logged per module, warnings and errors are never limited (0: no limit)')
+    parser.add_argument('--text-tx', action='store_true',
+                        help='always send t: messages, also when the firmware supports binary commands')
+    parser.add_argument('--record', metavar='FILE',
+                        help='append the received frames to a capture file, gzip compressed when it ends with .gz')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='handle the frames of a capture file instead of reading the serial ports, '
+                             'the HTTP server keeps running afterwards')
+    parser.add_argument('--replay-fast', action='store_true',
+                        help='replay as fast as possible instead of with the recorded timing')
     args = parser.parse_args()
+    # log records are written by a background thread, see LogPipeline
+    LogPipeline.setup(level=args.log_level, rate=args.log_rate)
+    Metrics.enabled = args.metrics
+    Transceiver.binary_tx = not args.text_tx
+    if args.server == 'waitress':
+        streams = args.threads // 2 if args.event_streams is None else args.event_streams
+        if not 0 <= streams < args.threads:
+            parser.error('--event-streams must be lower than --threads')
+        event_streams = threading.BoundedSemaphore(streams)
+    if args.record:
+        gateway.record(args.record)
 
     #gateway.load(args.database)
     # Setup two somfy screens
@@ -140,8 +289,17 @@ if __name__ == '__main__':
     #
     # gateway.add_device_type(UnknownDeviceType())
     # gateway.save(args.database)
-    threading.Thread(target=thread_runner, args=(args.host, args.port,)).start()
+    threading.Thread(target=thread_runner, args=(args.host, args.port, args.server, args.threads),
+                     daemon=True).start()
+    if args.replay:
+        logging.debug('Replaying {file}'.format(file=args.replay))
+        try:
+            gateway.replay(args.replay, realtime=not args.replay_fast)
+            threading.Event().wait()
+        finally:
+            gateway.close()
     logging.debug('Starting Gateway at {serial}'.format(serial=args.serial))
- #   gateway.run(com_port=args.serialport)
-    while True:
-        time.sleep(0.1)
+    if args.asyncio:
+        asyncio.run(gateway.run_async(com_ports=args.serial.split(',')))
+    else:
+        gateway.run(com_ports=args.serial.split(','))